@@ -4,11 +4,22 @@
 Converts CLI in ASCII format to GCODE
 '''
 
+import io
+import os
+import copy
+import itertools
 import argparse
 import re
 from enum import Enum
 import sys
 
+#bboxer lives at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+from bboxer import addRegionArguments, regionFromArguments, openOutput
+from meshData import compactPointList, compactConnectivity, segmentPoints
+from diagnostics import errorReport
+
 class LineType( Enum ):
     COMMENT         = 0
     HEADERSTART     = 1
@@ -72,115 +83,363 @@ def readCliLine( cliLine:str ):
     return (lineType, *listOMatches)
 
 
-def readCliFile( cliPath:str ):
+def readCliLines( cliLines:list, currZ=0.0, scaling=1, region=None,
+        compact=False, errors=None, firstLine=0 ):
     '''
-    Read CLI file and store it as a mesh:
+    Read CLI lines and store them as a mesh:
         pointList:      list of points
         connectivity:   pointsConnectivity
     Difference with classic pList, cList would be
     that here order matters.
+    currZ is the Z coordinate of the lines preceding
+    the first $$LAYER and scaling the scaling factor
+    preceding the first $$UNITS.
+    Points are not scaled, the scaling factor read in
+    $$UNITS is returned with them.
+    If region, a gcodeBBox in scaled units, is given,
+    only the segments crossing it are stored.
+    If compact, points and lines are stored as float32 and int32
+    in a compactPointList and a compactConnectivity (see meshData).
+    If errors, an errorReport, is given, malformed lines are
+    recorded in it and skipped, otherwise the first one raises
+    a ValueError giving its line number. Lines are numbered from
+    firstLine, the index in the file of the first of cliLines.
     '''
     #initialize point list and connectivity to []
-    pointList       = []
-    connectivity    = []
+    if compact:
+        pointList       = compactPointList()
+        connectivity    = compactConnectivity()
+    else:
+        pointList       = []
+        connectivity    = []
+
+    #region in the units of the file
+    fileRegion = scaledRegion( region, scaling )
+
+    #read each line
+    #errors are handled outside of the loop, which resumes
+    #on the shared iterator after the malformed line
+    lineIter = enumerate(cliLines, firstLine)
+    while True:
+        try:
+            for lineIndex, line in lineIter:
+                #skip new lines
+                if line=="\n":
+                    continue
+
+                #read the line into a tuple
+                lineTuple = readCliLine( line )
+
+                #first element is line type
+                lineType = lineTuple[0]
+
+                #depending on line type, specialized treatment
+                if lineType == LineType.LAYER:
+                    currZ = lineTuple[1]
+
+                if   lineType == LineType.UNITS:
+                    scaling = lineTuple[1]
+                    fileRegion = scaledRegion( region, scaling )
+                elif lineType == LineType.HATCHES:
+                    modelID =       int(lineTuple[1])
+                    numHatches =    int(lineTuple[2])
+                    #expecting numHatches*4 coordinates
+                    coords = lineTuple[3:]
+                    if len(coords)!= numHatches*4:
+                        raise ValueError("expected {} coordinates, "
+                                "found {}".format(numHatches*4, len(coords)))
+                    else:
+                        for i in range(numHatches):
+                            p1 = (*coords[4*i : 4*i+2], currZ)
+                            p2 = (*coords[4*i+2 : 4*(i+1)], currZ)
+                            if region is not None and \
+                                    not fileRegion.intersectsSegment(p1, p2):
+                                continue
+
+                            pointList.extend([p1, p2])
+                            connectivity.append( (len(pointList) - 2,
+                                len(pointList) - 1) )
+                elif lineType == LineType.POLYLINE and region is not None:
+                    numPoints = int(lineTuple[3])
+                    coords = lineTuple[4:]
+                    if len(coords) != numPoints*2:
+                        raise ValueError("expected {} coordinates, "
+                                "found {}".format(numPoints*2, len(coords)))
+                    points = [ (*coords[2*i : 2*(i+1)], currZ)
+                            for i in range(numPoints) ]
+                    #whether the previous segment was kept
+                    prevKept = False
+                    for p1, p2 in zip(points[:-1], points[1:]):
+                        if not fileRegion.intersectsSegment(p1, p2):
+                            prevKept = False
+                            continue
+                        if not prevKept:
+                            pointList.append(p1)
+                        pointList.append(p2)
+                        connectivity.append( (len(pointList) - 2,
+                            len(pointList) - 1) )
+                        prevKept = True
+                elif lineType == LineType.POLYLINE:
+                    numPoints = int(lineTuple[3])
+                    coords = lineTuple[4:]
+                    if len(coords) != numPoints*2:
+                        raise ValueError("expected {} coordinates, "
+                                "found {}".format(numPoints*2, len(coords)))
+                    #add first point outside of loop
+                    p = (*coords[0: 2], currZ)
+                    pointList.append(p)
+                    for i in range(numPoints-1):
+                        p = (*coords[2*(i+1) : 2*(i+2)], currZ)
+                        pointList.append(p)
+                        connectivity.append( (len(pointList) - 2,
+                            len(pointList) - 1) )
+            break
+        except Exception as e:
+            if errors is None and isinstance(e, ValueError):
+                raise ValueError("line {}: {}".format(lineIndex + 1, e)) \
+                        from None
+            if errors is None:
+                raise
+            errors.add(lineIndex, line, e)
+
+    return pointList, connectivity, scaling
+
+def scaledRegion( region, scaling ):
+    '''
+    Copy of region, given in scaled units, in the units of a file
+    with this scaling factor. None if region is None.
+    '''
+    if region is None or scaling == 1:
+        return region
+    fileRegion = copy.copy( region )
+    fileRegion.scale( 1 / scaling )
+    return fileRegion
+
+def scalePoints( pointList:list, scaling ):
+    '''
+    Scale in place the points of pointList.
+    '''
+    if scaling != 1 and isinstance(pointList, compactPointList):
+        pointList.scale(scaling)
+    elif scaling != 1:
+        for idx, p in enumerate(pointList):
+            pointList[idx] = tuple([scaling*x for x in p])
 
+def readCliFile( cliPath:str, region=None, compact=False, errors=None ):
+    '''
+    Read CLI file and store it as a mesh:
+        pointList:      list of points
+        connectivity:   pointsConnectivity
+    Difference with classic pList, cList would be
+    that here order matters.
+    If region, a gcodeBBox in scaled units, is given,
+    only the segments crossing it are stored.
+    If compact or errors, see readCliLines. The errors
+    are located in cliPath by their byte offsets.
+    '''
     #open file, store lines, close it
     cliLines = []
     with open( cliPath, 'r') as f:
         cliLines = f.readlines()
 
-    #read each line
-    currZ = 0.0 #initialize Z coordinate of current layer
-    scaling = 1 #initialize scaling factor to 1
-    for line in cliLines:
-        #skip new lines
-        if line=="\n":
-            continue
-
-        #read the line into a tuple
-        lineTuple = readCliLine( line )
-
-        #first element is line type
-        lineType = lineTuple[0]
-
-        #depending on line type, specialized treatment
-        if lineType == LineType.LAYER:
-            currZ = lineTuple[1]
-
-        if   lineType == LineType.UNITS:
-            scaling = lineTuple[1]
-        elif lineType == LineType.HATCHES:
-            modelID =       int(lineTuple[1])
-            numHatches =    int(lineTuple[2])
-            #expecting numHatches*4 coordinates
-            coords = lineTuple[3:]
-            if len(coords)!= numHatches*4:
-                print("Incorrect number of coordinates in line:\n",
-                       line ) 
-                sys.exit()
-            else:
-                for i in range(numHatches):
-                    p1 = (*coords[4*i : 4*i+2], currZ)
-                    p2 = (*coords[4*i+2 : 4*(i+1)], currZ)
-
-                    pointList.extend([p1, p2])
-                    connectivity.append( (len(pointList) - 2,
-                        len(pointList) - 1) )
-        elif lineType == LineType.POLYLINE:
-            numPoints = int(lineTuple[3])
-            coords = lineTuple[4:]
-            #add first point outside of loop
-            p = (*coords[0: 2], currZ)
-            pointList.append(p)
-            for i in range(numPoints-1):
-                p = (*coords[2*(i+1) : 2*(i+2)], currZ)
-                pointList.append(p)
-                connectivity.append( (len(pointList) - 2,
-                    len(pointList) - 1) )
+    pointList, connectivity, scaling = readCliLines( cliLines,
+            region=region, compact=compact, errors=errors )
+    if errors:
+        with open( cliPath, 'rb' ) as f:
+            errors.locate( f.read() )
 
     #scale
-    if scaling != 1:
-        for idx, p in enumerate(pointList):
-            pointList[idx] = tuple([scaling*x for x in p])
+    scalePoints( pointList, scaling )
 
     return pointList, connectivity
 
+def writeGcodeLines( f, pointList, connectivity, E=0.0, currZ=-1 ):
+    '''
+    Write the segments of connectivity as gcode lines to the
+    opened file f, starting from extrusion E and layer height currZ.
+    Return E and currZ after the last segment.
+    '''
+    for p1, p2 in segmentPoints( pointList, connectivity ):
+        #increase slightly E
+        E += 0.1
+        #update current Z if necessary and write Z line
+        if p1[2] != currZ:
+            currZ = p1[2]
+            zLine = "G0 Z{}\n".format( currZ )
+            f.write( zLine )
+
+        #prepare strings. extrusion axis set to 1.0 (does not increase!)
+        positionningLine = "G0 X{} Y{}\n".format( *p1[0:2] )
+        extrusionLine    = "G1 X{} Y{} E{}\n".format( *p2[0:2], round(E, 2) )
+
+        #write to file
+        f.write( positionningLine + extrusionLine )
+    return E, currZ
+
 def write2gcode( path2gcode, pointList, connectivity, speed=-1):
     '''
     Write the contents of
         pointlist p
         connectivity list c
-    to a gcode file path2gcode
+    to a gcode file path2gcode, a path or an opened text file
     '''
-    #initialize extrusion axis to 0.0 and current Z to impossible value
-    E = 0.0
-    currZ = -1
-    with open( path2gcode, 'w' ) as f:
+    with openOutput( path2gcode ) as f:
         #write velocity in first line
         if (speed>0):
             velocityLine = "G0 F{}\n".format(speed)
             f.write( velocityLine)
-        for line in connectivity:
-            #get points
-            p1 = pointList[line[0]]
-            p2 = pointList[line[1]]
-            #increase slightly E
-            E += 0.1
-            #update current Z if necessary and write Z line
-            if p1[2] != currZ:
-                currZ = p1[2]
-                zLine = "G0 Z{}\n".format( currZ )
-                f.write( zLine )
-
-            #prepare strings. extrusion axis set to 1.0 (does not increase!)
-            positionningLine = "G0 X{} Y{}\n".format( *p1[0:2] )
-            extrusionLine    = "G1 X{} Y{} E{}\n".format( *p2[0:2], round(E, 2) )
-
-            #write to file
-            f.write( positionningLine + extrusionLine )
+        #initialize extrusion axis to 0.0 and current Z to impossible value
+        writeGcodeLines( f, pointList, connectivity, 0.0, -1 )
 
-if __name__=="__main__":
+#number of segments of HATCHES and POLYLINE lines,
+#read without parsing the coordinates
+numHatchesPattern = re.compile(r"^\$\$HATCHES/\s*[^,\s]+[,\s]+([^,\s]+)")
+numPointsPattern  = re.compile(
+        r"^\$\$POLYLINE/\s*[^,\s]+[,\s]+[^,\s]+[,\s]+([^,\s]+)")
+
+def splitCliLayers( cliLines:list ):
+    '''
+    Split CLI lines at each $$LAYER record.
+    Return a list of (layer Z, lines, number of segments),
+    the first entry holding the lines before the first layer.
+    '''
+    layers = [ [0.0, [], 0] ]
+    for line in cliLines:
+        if line.startswith("$$LAYER/"):
+            layers.append( [readCliLine(line)[1], [], 0] )
+        layer = layers[-1]
+        layer[1].append(line)
+        match = numHatchesPattern.match(line)
+        if match:
+            layer[2] += int(float(match.group(1)))
+            continue
+        match = numPointsPattern.match(line)
+        if match:
+            layer[2] += max(int(float(match.group(1))) - 1, 0)
+    return [ tuple(layer) for layer in layers ]
+
+def countCliLayerSegments( task:tuple ):
+    '''
+    Number of segments of one CLI layer crossing a region.
+    task is (lines, layer Z, scaling, region, index of the first line).
+    '''
+    cliLines, layerZ, scaling, region, firstLine = task
+    _, connectivity, _ = readCliLines( cliLines, layerZ, scaling, region,
+            firstLine=firstLine )
+    return len(connectivity)
+
+def convertCliLayer( task:tuple ):
+    '''
+    Convert the lines of one CLI layer to gcode.
+    task is (lines, layer Z, scaling, region, E, currZ, path,
+    index of the first line, compact), E and currZ being the state
+    of the gcode writer before this layer.
+    The gcode is written to path or returned if path is None.
+    '''
+    cliLines, layerZ, scaling, region, E, currZ, path, firstLine, \
+            compact = task
+    pointList, connectivity, _ = readCliLines( cliLines, layerZ,
+            scaling, region, compact, firstLine=firstLine )
+    scalePoints( pointList, scaling )
+
+    f = io.StringIO()
+    writeGcodeLines( f, pointList, connectivity, E, currZ )
+    if path is None:
+        return f.getvalue()
+    with open( path, 'w' ) as shard:
+        shard.write( f.getvalue() )
+    return path
+
+def layerShardPath( path2gcode:str, layerIndex:int ):
+    '''
+    Path of the shard of layer layerIndex: part.gcode -> part.00012.gcode
+    '''
+    head, ext = os.path.splitext( path2gcode )
+    return "{}.{:05d}{}".format( head, layerIndex, ext )
 
+def write2gcodeParallel( cliPath:str, path2gcode:str, speed=-1,
+        numWorkers=None, shards=False, region=None, compact=False ):
+    '''
+    Convert CLI file cliPath to gcode, one $$LAYER block per task
+    of a process pool of numWorkers processes.
+
+    The layers are concatenated in order into path2gcode, giving
+    the same file as write2gcode, or written to one shard per
+    layer (see layerShardPath) if shards is True. Shards are
+    named after path2gcode and their concatenation in order
+    is that same file.
+    If region is given, only the segments crossing it are kept;
+    the layers are then read twice, once to count those segments.
+    If compact, the layers are read as in readCliLines.
+    Return the list of written files.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    with open( cliPath, 'r') as f:
+        cliLines = f.readlines()
+    layers = splitCliLayers( cliLines )
+
+    #the scaling factor is in the header
+    scaling = 1
+    for line in layers[0][1]:
+        if line.startswith("$$UNITS"):
+            scaling = readCliLine(line)[1]
+
+    velocityLine = "G0 F{}\n".format(speed) if speed > 0 else ""
+    #index in the file of the first line of each layer
+    firstLines = list( itertools.accumulate(
+        [ len(lines) for _, lines, _ in layers[:-1] ], initial=0 ) )
+    written = []
+    numWorkers = numWorkers or os.cpu_count()
+    #a few chunks of layers per worker
+    chunksize = max( 1, len(layers) // (4*numWorkers) )
+    with ProcessPoolExecutor( numWorkers ) as pool:
+        if region is None:
+            counts = [ numSegments for _, _, numSegments in layers ]
+        else:
+            counts = list( pool.map( countCliLayerSegments,
+                [ (lines, layerZ, scaling, region, firstLine)
+                    for (layerZ, lines, _), firstLine in
+                        zip(layers, firstLines) ],
+                chunksize=chunksize ) )
+
+        #state of the writer at the start of each layer
+        tasks = []
+        E = 0.0
+        currZ = -1
+        for layerIndex, ((layerZ, lines, _), numSegments, firstLine) in \
+                enumerate(zip(layers, counts, firstLines)):
+            path = layerShardPath( path2gcode, layerIndex ) if shards else None
+            tasks.append( (lines, layerZ, scaling, region, E, currZ, path,
+                firstLine, compact) )
+            if numSegments:
+                #same float operations as writeGcodeLines
+                for _ in range(numSegments):
+                    E += 0.1
+                currZ = layerZ if scaling == 1 else scaling*layerZ
+
+        results = pool.map( convertCliLayer, tasks, chunksize=chunksize )
+        if shards:
+            written = list(results)
+            #velocity line at the beginning of the first shard
+            if velocityLine:
+                with open( written[0], 'r' ) as f:
+                    firstShard = f.read()
+                with open( written[0], 'w' ) as f:
+                    f.write( velocityLine + firstShard )
+        else:
+            with open( path2gcode, 'w' ) as f:
+                f.write( velocityLine )
+                for gcode in results:
+                    f.write( gcode )
+            written = [path2gcode]
+    return written
+
+def main(argv=None):
+    '''
+    Command line entry point. argv defaults to sys.argv[1:].
+    Return 1 if the CLI file is malformed.
+    '''
     parser = argparse.ArgumentParser(description="Convert CLI to gcode.")
     parser.add_argument( 'cliPath', type=str, nargs=1,
             help="Path to CLI file." )
@@ -188,8 +447,21 @@ if __name__=="__main__":
             help="Path to gcode file to be written" )
     parser.add_argument( 'speed', type=float, nargs='?',
             help="Scanning speed" )
+    parser.add_argument( '-j', '--jobs', type=int, default=1,
+            help="Number of processes converting layers in parallel.\
+                    0 for one per core." )
+    parser.add_argument( '--shards', action='store_true',
+            help="Write one gcode file per layer instead of\
+                    a single file." )
+    parser.add_argument( '--lenient', action='store_true',
+            help="Skip malformed lines instead of stopping,\
+                    and report them." )
+    parser.add_argument( '--compact', action='store_true',
+            help="Store points as float32 and lines as int32\
+                    while converting, for very large files." )
+    addRegionArguments( parser )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     #unpack
     cliFile = args.cliPath[0]
@@ -202,8 +474,31 @@ if __name__=="__main__":
     else:
         speed = args.speed
 
-    #get points and connectivities from CLI file
-    p, c = readCliFile(cliFile)
+    region = regionFromArguments( args )
+
+    if args.lenient and (args.jobs != 1 or args.shards):
+        parser.error( "--lenient needs -j 1 and no --shards" )
+
+    try:
+        if args.jobs != 1 or args.shards:
+            numWorkers = args.jobs if args.jobs > 0 else None
+            write2gcodeParallel( cliFile, gcodePath, speed,
+                    numWorkers, args.shards, region, args.compact )
+            return 0
+
+        #get points and connectivities from CLI file
+        errors = errorReport() if args.lenient else None
+        p, c = readCliFile(cliFile, region, args.compact, errors)
+    except ValueError as e:
+        print("Malformed CLI file {}: {}".format(cliFile, e))
+        return 1
+    if errors:
+        print("Skipped {} malformed lines".format(len(errors)))
+        errors.print(cliFile)
 
     #write them to gcode file
     write2gcode( gcodePath, p, c, speed )
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main())
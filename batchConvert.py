@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+
+'''
+Converts many files at once, for inputs on network storage.
+
+On NFS and similar mounts the latency of opening and reading each
+file, not the bandwidth, dominates the conversion of many small files.
+Here up to --prefetch files are read concurrently into memory, each
+buffer is parsed and converted by a pool of -j processes while other
+files are still being read, and the outputs are written back
+concurrently as well.
+
+Reads and writes go through a filesystem object (localFS); latencyFS
+adds a delay to each of them, to try the batch locally as if the
+files were on a network mount (--latency).
+
+    python batchConvert.py gcode2vtk parts/*.gcode -o vtk/ -j 8
+'''
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import logging
+
+#the converters live in their own directories
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "gcode2vtk"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "gcode2CLI"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "CLI2gcode"))
+from gcode2vtk import readGcodeLines, write2VtkFile
+from gcode2CLI import write2CLI
+from cli2gcode import readCliLines, scalePoints, write2gcode
+from diagnostics import errorReport
+
+class localFS:
+    '''
+    Blocking reads of whole files, as bytes, and writes
+    of whole text files.
+    '''
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+class latencyFS(localFS):
+    '''
+    localFS waiting latency seconds before each read and write,
+    a stand-in for network storage.
+    '''
+    def __init__(self, latency):
+        self.latency = latency
+
+    def read(self, path):
+        time.sleep(self.latency)
+        return super().read(path)
+
+    def write(self, path, text):
+        time.sleep(self.latency)
+        super().write(path, text)
+
+#tool name -> suffix of the outputs, as the tools name them
+SUFFIXES = {
+        "gcode2vtk" : "-gcode.vtk",
+        "gcode2CLI" : ".CLI",
+        "cli2gcode" : ".gcode",
+        }
+
+def outputPath( inputPath:str, tool:str, outputDir=None ):
+    '''
+    Path of the output of tool for inputPath, next to it
+    or in outputDir.
+    '''
+    head = os.path.splitext(inputPath)[0]
+    if outputDir is not None:
+        head = os.path.join(outputDir, os.path.basename(head))
+    return head + SUFFIXES[tool]
+
+def convertBuffer( task:tuple ):
+    '''
+    Convert the content of an input file, as bytes, with tool.
+    task is (tool, raw, options) with options a dictionnary of
+    scaling (gcode2vtk), shifting (gcode2CLI), speed (cli2gcode),
+    arcTolerance, relativeExtrusion, compact and lenient.
+    Return the text of the output file and the errorReport of the
+    malformed lines skipped if lenient, None otherwise.
+    '''
+    import io
+
+    tool, raw, options = task
+    #lines as read in text mode, errors located in raw
+    lines = io.StringIO(raw.decode(), newline=None).readlines()
+    errors = errorReport() if options.get("lenient", False) else None
+    out = io.StringIO()
+    if tool == "cli2gcode":
+        p, c, scaling = readCliLines(lines,
+                compact=options.get("compact", False), errors=errors)
+        scalePoints(p, scaling)
+        write2gcode(out, p, c, options.get("speed", 600))
+    else:
+        p, c = readGcodeLines(lines, options.get("arcTolerance", 0.01),
+                options.get("relativeExtrusion", False),
+                compact=options.get("compact", False), errors=errors)
+        if tool == "gcode2vtk":
+            write2VtkFile(out, p, c, options.get("scaling", 1e-3))
+        else:
+            write2CLI(out, p, c, options.get("shifting", True))
+    if errors:
+        errors.locate(raw)
+    return out.getvalue(), errors
+
+async def convertFiles( tool:str, paths:list, options:dict, outputDir=None,
+        fs=None, prefetch=16, numWorkers=None ):
+    '''
+    Convert the files of paths with tool (see convertBuffer).
+
+    At most prefetch files are in flight, from the start of their
+    read to the end of their write, which bounds the memory used
+    by the buffers. Reads and writes run in threads, conversions
+    in a pool of numWorkers processes.
+    Return a dictionnary of input path: error message for the
+    files that could not be converted. With the lenient option,
+    files with malformed lines are converted and their
+    errorReport logged.
+    '''
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+    fs = fs or localFS()
+    loop = asyncio.get_running_loop()
+    inFlight = asyncio.Semaphore(prefetch)
+    failed = {}
+
+    async def convertFile( path ):
+        async with inFlight:
+            try:
+                raw = await loop.run_in_executor(ioPool, fs.read, path)
+                output, errors = await loop.run_in_executor(cpuPool,
+                        convertBuffer, (tool, raw, options))
+                del raw
+                target = outputPath(path, tool, outputDir)
+                await loop.run_in_executor(ioPool, fs.write, target, output)
+                logging.info("Converted {} to {}".format(path, target))
+                if errors:
+                    logging.warning("Skipped {} malformed lines of {}, "
+                            "first at line {}, byte {}".format(len(errors),
+                                path, errors.lineNumbers[0],
+                                errors.offsets[0]))
+            except Exception as e:
+                failed[path] = "{}: {}".format(type(e).__name__, e)
+                logging.error("Failed to convert {}: {}"
+                        .format(path, failed[path]))
+
+    with ThreadPoolExecutor(prefetch) as ioPool, \
+            ProcessPoolExecutor(numWorkers) as cpuPool:
+        await asyncio.gather(*[ convertFile(p) for p in paths ])
+    return failed
+
+def main(argv=None):
+    '''
+    Command line entry point. argv defaults to sys.argv[1:].
+    Logging is configured by the caller.
+    Return 1 if a file could not be converted.
+    '''
+    parser = argparse.ArgumentParser(description=
+            "Convert many files, reading and writing them concurrently.")
+    parser.add_argument('tool', choices=tuple(SUFFIXES),
+            help="Conversion of every input file.")
+    parser.add_argument('inputs', nargs='+', help="Paths of the inputs.")
+    parser.add_argument('-o', '--output-dir', dest='outputDir',
+            help="Directory of the outputs, next to the inputs\
+                    by default.")
+    parser.add_argument('--prefetch', type=int, default=16,
+            help="Number of files read, converted or written\
+                    at the same time.")
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+            help="Number of converting processes. 0 for one per core.")
+    parser.add_argument('--latency', type=float, default=0.0,
+            help="Delay in [s] added to each read and write,\
+                    to simulate network storage.")
+    parser.add_argument('--scaling', type=float, default=1e-3,
+            help="Scaling of the .vtk coordinates (gcode2vtk).")
+    parser.add_argument('--speed', type=float, default=600,
+            help="Scanning speed (cli2gcode).")
+    parser.add_argument('--no-shifting', action='store_false',
+            dest='shifting',
+            help="Do not shift the hatch ends (gcode2CLI).")
+    parser.add_argument('--arc-tolerance', type=float, default=0.01,
+            dest='arcTolerance',
+            help="Maximal distance between G2/G3 arcs and\
+                    the segments replacing them, in gcode units.")
+    parser.add_argument('--relative-extrusion', action='store_true',
+            dest='relativeExtrusion',
+            help="Start in relative extrusion mode (M83).")
+    parser.add_argument('--compact', action='store_true',
+            help="Store points as float32 and lines as int32.")
+    parser.add_argument('--lenient', action='store_true',
+            help="Skip malformed lines instead of failing the file.")
+
+    args = parser.parse_args(argv)
+    if not args.arcTolerance > 0:
+        parser.error("--arc-tolerance must be positive")
+
+    options = { key : getattr(args, key) for key in ("scaling", "speed",
+        "shifting", "arcTolerance", "relativeExtrusion", "compact",
+        "lenient") }
+    fs = latencyFS(args.latency) if args.latency > 0 else localFS()
+    if args.outputDir:
+        os.makedirs(args.outputDir, exist_ok=True)
+
+    start = time.perf_counter()
+    failed = asyncio.run(convertFiles(args.tool, args.inputs, options,
+        args.outputDir, fs, args.prefetch, args.jobs or None))
+    elapsed = time.perf_counter() - start
+
+    logging.info("Converted {} of {} files in {:.2f} s"
+            .format(len(args.inputs) - len(failed), len(args.inputs),
+                elapsed))
+    if failed:
+        return 1
+    return 0
+
+if __name__=="__main__":
+    #log file settings
+    logging.basicConfig(filename="logfile", level=logging.INFO,
+            format="%(levelname)s:%(message)s")
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+    sys.exit(main())
@@ -1,5 +1,4 @@
 #!/usr/bin/python3
-import re
 import sys
 import argparse
 import logging
@@ -19,17 +18,17 @@ class gcodeBBox:
         if axis=='x':
             if val < self.xMin:
                 self.xMin = val
-            elif val > self.xMax:
+            if val > self.xMax:
                 self.xMax = val
         elif axis=='y':
             if val < self.yMin:
                 self.yMin = val
-            elif val > self.yMax:
+            if val > self.yMax:
                 self.yMax = val
         elif axis=='z':
             if val < self.zMin:
                 self.zMin = val
-            elif val > self.zMax:
+            if val > self.zMax:
                 self.zMax = val
         else:
             print("Invalid axis value.")
@@ -84,6 +83,51 @@ class gcodeBBox:
         self.zMin += c[2]
         self.zMax += c[2]
 
+    def scale(self, factor):
+        '''
+        Scaling by factor around the origin
+        '''
+        self.xMin *= factor
+        self.xMax *= factor
+        self.yMin *= factor
+        self.yMax *= factor
+        self.zMin *= factor
+        self.zMax *= factor
+
+    def contains(self, p):
+        '''
+        Whether point p is in the box, boundary included
+        '''
+        return self.xMin <= p[0] <= self.xMax and \
+                self.yMin <= p[1] <= self.yMax and \
+                self.zMin <= p[2] <= self.zMax
+
+    def intersectsSegment(self, p1, p2):
+        '''
+        Whether some point of segment p1-p2 is in the box.
+        Clips the parameter range of the segment against
+        each pair of planes of the box (slab method).
+        '''
+        if self.contains(p1) or self.contains(p2):
+            return True
+        tMin, tMax = 0.0, 1.0
+        for a, b, low, high in zip(p1, p2,
+                (self.xMin, self.yMin, self.zMin),
+                (self.xMax, self.yMax, self.zMax)):
+            d = b - a
+            if d == 0:
+                if a < low or a > high:
+                    return False
+                continue
+            tLow  = (low - a) / d
+            tHigh = (high - a) / d
+            if tLow > tHigh:
+                tLow, tHigh = tHigh, tLow
+            tMin = max(tMin, tLow)
+            tMax = min(tMax, tHigh)
+            if tMin > tMax:
+                return False
+        return True
 
     def print(self):
         print("")
@@ -124,35 +168,144 @@ class gcodeBBox:
         BC = self.getBoundingCube()
         BC.write(FileName)
 
+    def getMesh(self, h, layersPerElement=1):
+        '''
+        Structured hexahedral mesh of the box.
+
+        Elements are about h wide along x and y, the box being
+        split in equal parts, and layersPerElement layers high,
+        down from zMax. zMin is lowered to a whole number of
+        elements so that element faces follow the layers, at the
+        nozzle heights, the beads being below them: a single layer
+        gets one element under it. Without padding the beads of
+        the first layer are below zMin.
+        Return (nodes, elements): an array of node coordinates and
+        an array of the 8 node indices (from 0) of each element, in
+        the node order of write.
+        '''
+        import numpy as np
+
+        dz = layersPerElement * self.layerHeight
+        nx = max(1, round((self.xMax - self.xMin) / h))
+        ny = max(1, round((self.yMax - self.yMin) / h))
+        nz = max(1, int(np.ceil((self.zMax - self.zMin) / dz - 1e-9)))
+
+        x = np.linspace(self.xMin, self.xMax, nx + 1)
+        y = np.linspace(self.yMin, self.yMax, ny + 1)
+        z = self.zMax - dz * np.arange(nz, -1, -1)
+        #node (i, j, k) has index i + (nx+1)*(j + (ny+1)*k)
+        Z, Y, X = np.meshgrid(z, y, x, indexing="ij")
+        nodes = np.stack([X.ravel(), Y.ravel(), Z.ravel()], axis=1)
+
+        #lowest node of each element
+        k, j, i = np.meshgrid(np.arange(nz), np.arange(ny), np.arange(nx),
+                indexing="ij")
+        first = (i + (nx+1)*(j + (ny+1)*k)).ravel()
+        #node order of write:
+        #+x+y+z, -x+y+z, -x+y-z, +x+y-z, +x-y+z, -x-y+z, -x-y-z, +x-y-z
+        di = np.array([1, 0, 0, 1, 1, 0, 0, 1])
+        dj = np.array([1, 1, 1, 1, 0, 0, 0, 0])
+        dk = np.array([1, 1, 0, 0, 1, 1, 0, 0])
+        offsets = di + (nx+1)*(dj + (ny+1)*dk)
+        elements = first[:, None] + offsets[None, :]
+
+        return nodes, elements
+
+    def writeMesh(self, FileName, h, layersPerElement=1):
+        '''
+        Write the structured mesh of getMesh in the format of write.
+        Coordinates are written with 4 decimals of [mm].
+        '''
+        import numpy as np
+
+        nodes, elements = self.getMesh(h, layersPerElement)
+        #rows of "count 8 nodes" and "count x y z"
+        elementRows = np.empty((len(elements), 10), dtype=np.int64)
+        elementRows[:, 0] = np.arange(1, len(elements) + 1)
+        elementRows[:, 1] = 8
+        elementRows[:, 2:] = elements + 1
+        nodeRows = np.empty((len(nodes), 4))
+        nodeRows[:, 0] = np.arange(1, len(nodes) + 1)
+        nodeRows[:, 1:] = nodes
+
+        #format many lines at once
+        chunk = 100000
+        with open(FileName, "w") as MeshFile:
+            MeshFile.write("ELEMENTS NEWFORMAT\n")
+            fs = "%d" + " %d"*9 + "\n"
+            for start in range(0, len(elementRows), chunk):
+                part = elementRows[start : start + chunk]
+                MeshFile.write((fs*len(part)) % tuple(part.ravel().tolist()))
+            MeshFile.write("COORDINATES\n")
+            fs = "%2d" + "%12.4fe-3"*3 + "\n"
+            for start in range(0, len(nodeRows), chunk):
+                part = nodeRows[start : start + chunk]
+                MeshFile.write((fs*len(part)) % tuple(part.ravel().tolist()))
+            MeshFile.write("END_COORDINATES\n")
+            MeshFile.write("END_ELEMENTS\n")
+
+        logging.info("Wrote mesh of {} elements to file\n {}"
+                .format(len(elements), FileName))
+
+    def writeMeshVtk(self, FileName, h, layersPerElement=1, scaling=1e-3):
+        '''
+        Write the structured mesh of getMesh to a legacy binary VTK
+        unstructured grid, coordinates scaled by scaling.
+        '''
+        import numpy as np
+
+        nodes, elements = self.getMesh(h, layersPerElement)
+        #VTK hexahedron: -z face counterclockwise, then +z face
+        vtkOrder = [6, 7, 3, 2, 5, 4, 0, 1]
+        cells = np.empty((len(elements), 9), dtype=">i4")
+        cells[:, 0] = 8
+        cells[:, 1:] = elements[:, vtkOrder]
+        with open(FileName, "wb") as MeshFile:
+            MeshFile.write(b"# vtk DataFile Version 2.0\n")
+            MeshFile.write(b"Bounding box mesh\n")
+            MeshFile.write(b"BINARY\n")
+            MeshFile.write(b"DATASET UNSTRUCTURED_GRID\n")
+            MeshFile.write("POINTS {} float\n".format(len(nodes)).encode())
+            MeshFile.write((scaling * nodes).astype(">f4").tobytes())
+            MeshFile.write("\nCELLS {} {}\n"
+                    .format(len(cells), cells.size).encode())
+            MeshFile.write(cells.tobytes())
+            MeshFile.write("\nCELL_TYPES {}\n".format(len(cells)).encode())
+            MeshFile.write(np.full(len(cells), 12, dtype=">i4").tobytes())
+            MeshFile.write(b"\n")
+
+        logging.info("Wrote mesh of {} elements to file\n {}"
+                .format(len(elements), FileName))
+
 
 def bboxFromGcode(FileName, literal=True):
+    '''
+    Bounding box of the extruded segments of a .gcode, as read by
+    gcode2vtk (arcs, relative moves and G92 included), its layer
+    height being the Z spacing of the segments.
+    If not literal, the box is padded by half a nozzle in x and y
+    and by a layer below, to contain the beads.
+    '''
+    import os
+    import numpy as np
+
+    #gcode2vtk imports this module, hence the late import
+    sys.path.insert(0, os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), "gcode2vtk"))
+    from gcode2vtk import readGcodeFile, layerHeightOf
+
     logging.info("About to compute bounding box of following gcode:\n{}"
             .format(FileName))
     bb = gcodeBBox()
-    with open(FileName, "r") as gcodeFile:
-        lines = gcodeFile.readlines()
-        for iteration, line in enumerate(lines):
-            XPattern = r"^G0?[01] .*X([+-]?(\d+)(\.\d+)?)"
-            YPattern = r"^G0?[01] .*Y([+-]?(\d+)(\.\d+)?)"
-            ZPattern = r"^G0?[01] .*Z([+-]?(\d+)(\.\d+)?)"
-            endPattern = ";End of Gcode"
-            xMatch = re.search(XPattern, line)
-            yMatch = re.search(YPattern, line)
-            zMatch = re.search(ZPattern, line)
-            endMatch = re.search(endPattern, line)
-            if xMatch:
-                bb.update('x', float(xMatch.group(1)))
-            if yMatch:
-                bb.update('y', float(yMatch.group(1)))
-            if zMatch:
-                if not(bb.layerHeight or (bb.zMax == float('-inf'))):
-                    bb.layerHeight = round(float(zMatch.group(1)) - bb.zMax, 2)
-                bb.update('z', float(zMatch.group(1)))
-            if endMatch:
-                logging.info("Detected end of file at line {} out of {}."
-                        .format(iteration, len(lines)))
-                break
-        
+    pointList, connectivity = readGcodeFile(FileName)
+    if connectivity:
+        points = np.asarray(pointList, dtype=float).reshape(-1, 3)
+        bb.xMin, bb.yMin, bb.zMin = points.min(axis=0).tolist()
+        bb.xMax, bb.yMax, bb.zMax = points.max(axis=0).tolist()
+        bb.layerHeight = layerHeightOf(pointList, connectivity)
+    else:
+        logging.warning("No extrusion found in {}".format(FileName))
+
     if not literal:
         halfNozzleDiam = bb.nozzleDiam / 2
 
@@ -195,15 +348,92 @@ def bboxFromCenterHalfLengths( c, L2, W2, H2 ):
 
     return bb
 
-if __name__=="__main__":
+def bboxFromBounds( xMin=float('-inf'), xMax=float('+inf'),
+        yMin=float('-inf'), yMax=float('+inf'),
+        zMin=float('-inf'), zMax=float('+inf') ):
+    '''
+    Build bounding box from its bounds.
+    Bounds not given are infinite, e.g. a Z range is
+    bboxFromBounds( zMin=0.2, zMax=1.0 )
+    '''
+    bb = gcodeBBox()
+    bb.xMin = xMin
+    bb.xMax = xMax
+    bb.yMin = yMin
+    bb.yMax = yMax
+    bb.zMin = zMin
+    bb.zMax = zMax
+
+    return bb
+
+def addRegionArguments( parser ):
+    '''
+    Add the options selecting a region of interest
+    to the argparse parser of a converter.
+    '''
+    parser.add_argument('--region', nargs=6, type=float,
+            metavar=('XMIN', 'XMAX', 'YMIN', 'YMAX', 'ZMIN', 'ZMAX'),
+            help='Only keep segments crossing this box, in the\
+                    units of the points read: those of the gcode,\
+                    or for CLI files, their coordinates scaled by\
+                    $$UNITS, i.e. [mm].')
+    parser.add_argument('--zrange', nargs=2, type=float,
+            metavar=('ZMIN', 'ZMAX'),
+            help='Only keep segments crossing this Z range,\
+                    in the units of --region.')
+
+def regionFromArguments( args ):
+    '''
+    Region of interest given by the options of addRegionArguments,
+    None if there is none.
+    '''
+    if not (args.region or args.zrange):
+        return None
+    if args.region:
+        region = bboxFromBounds( *args.region )
+    else:
+        region = bboxFromBounds()
+    if args.zrange:
+        region.zMin, region.zMax = args.zrange
+    return region
+
+def openOutput( file, mode='w' ):
+    '''
+    Open the path file for writing. If file is already an opened
+    file, e.g. an io.StringIO, it is returned as is and left
+    open: writers taking either can use with openOutput(file).
+    '''
+    import contextlib
+
+    if hasattr(file, "write"):
+        return contextlib.nullcontext( file )
+    return open( file, mode )
+
+def main(argv=None):
+    '''
+    Command line entry point. argv defaults to sys.argv[1:].
+    Logging is configured by the caller.
+    '''
     #arguments
     parser = argparse.ArgumentParser(description="Write bounding box of a .gcode")
     parser.add_argument('gcodeFile', nargs=1, help="Path of .gcode file")
     parser.add_argument('bboxFile', nargs='?', help="Path of output.")
     parser.add_argument('--type', default="box")
     parser.add_argument('-n', '--nono', action='store_true')
+    parser.add_argument('--padded', action='store_true',
+            help="Pad the box by half a nozzle in x and y\
+                    and by a layer below.")
+    parser.add_argument('--mesh', type=float, metavar='H',
+            help="Write a structured hexahedral mesh of\
+                    element size H [mm] instead of a single element,\
+                    with --padded to contain the first layer.")
+    parser.add_argument('--layers-per-element', type=int, default=1,
+            dest='layersPerElement',
+            help="Element height of the mesh, in layers.")
+    parser.add_argument('--vtk', metavar='PATH',
+            help="Also write the mesh to a binary .vtk file.")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     gCodeFile   = args.gcodeFile[0]
     runType     = args.type
@@ -213,19 +443,26 @@ if __name__=="__main__":
     else:
         BBoxFile    = "bbox.geo.dat"
 
-    #set up logging
-    logging.basicConfig(filename='logfile.log', level=logging.DEBUG)
-    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
-
     #run
-    bb = bboxFromGcode(gCodeFile)
+    bb = bboxFromGcode(gCodeFile, literal=not args.padded)
     if runType=="cube":
         bb = bb.getBoundingCube()
 
     bb.print()
 
-    if not onlyPrint:
+    if args.mesh and not onlyPrint:
+        bb.writeMesh(BBoxFile, args.mesh, args.layersPerElement)
+        if args.vtk:
+            bb.writeMeshVtk(args.vtk, args.mesh, args.layersPerElement)
+    elif not onlyPrint:
         bb.write(BBoxFile)
         with open(BBoxFile, "r") as WrittenFile:
             for line in WrittenFile.readlines():
                 print(line, end='')
+
+if __name__=="__main__":
+    #set up logging
+    logging.basicConfig(filename='logfile.log', level=logging.DEBUG)
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+    main()
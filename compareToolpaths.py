@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+'''
+Compares two toolpaths, .gcode or .CLI, segment by segment.
+
+Meant for round trip regressions, e.g. gcode -> gcode2CLI -> cli2gcode,
+where coordinates are rounded and shifted (see write2CLI) so that files
+cannot be compared line by line.
+
+Segments are paired one to one, closest first, within --displacement.
+A paired segment of the first toolpath is matched if the endpoints are
+within --tolerance of each other, in either direction, and displaced
+otherwise. Unpaired segments of the first toolpath are missing, those
+of the second one extra, so that dropped or duplicated segments are
+reported. Counts are reported per layer and the exit status is 1 if
+any segment is not matched.
+
+Requires NumPy.
+'''
+
+import os
+import sys
+import argparse
+import logging
+import itertools
+
+#the readers live in gcode2vtk and CLI2gcode
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "gcode2vtk"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "CLI2gcode"))
+from gcode2vtk import readGcodeFile
+from cli2gcode import readCliFile
+
+def readToolpath( path:str ):
+    '''
+    Segments of a .gcode or .CLI file as an array of shape (n, 2, 3).
+    '''
+    import numpy as np
+
+    if path.lower().endswith(".cli"):
+        pointList, connectivity = readCliFile( path )
+    else:
+        pointList, connectivity = readGcodeFile( path )
+    points = np.asarray(pointList, dtype=float).reshape(-1, 3)
+    lines = np.asarray(connectivity, dtype=np.int64).reshape(-1, 2)
+    return points[lines]
+
+def segmentDistance( a, b ):
+    '''
+    Largest endpoint distance between the segments of a and b,
+    arrays of shape (n, 2, 3), taking the best direction.
+    '''
+    import numpy as np
+
+    forward = np.maximum(np.linalg.norm(a[:, 0] - b[:, 0], axis=1),
+            np.linalg.norm(a[:, 1] - b[:, 1], axis=1))
+    backward = np.maximum(np.linalg.norm(a[:, 0] - b[:, 1], axis=1),
+            np.linalg.norm(a[:, 1] - b[:, 0], axis=1))
+    return np.minimum(forward, backward)
+
+def candidatePairs( query, ref, radius:float, chunk=100000 ):
+    '''
+    Pairs of segments of query and ref, arrays of shape (n, 2, 3),
+    with a segmentDistance of at most radius.
+    Return the query indices, ref indices and distances of the pairs.
+
+    ref is indexed by a uniform grid of cell size radius over
+    the segment midpoints: a segment within radius has its midpoint
+    within radius, hence in one of the 27 cells around the query.
+    '''
+    import numpy as np
+
+    queryIndices = [np.zeros(0, dtype=np.int64)]
+    refIndices = [np.zeros(0, dtype=np.int64)]
+    distances = [np.zeros(0)]
+    if len(query) == 0 or len(ref) == 0:
+        return queryIndices[0], refIndices[0], distances[0]
+
+    queryMid = query.mean(axis=1)
+    refMid = ref.mean(axis=1)
+    origin = np.minimum(queryMid.min(axis=0), refMid.min(axis=0)) - radius
+    queryCell = np.floor((queryMid - origin) / radius).astype(np.int64)
+    refCell = np.floor((refMid - origin) / radius).astype(np.int64)
+    dims = np.maximum(queryCell.max(axis=0), refCell.max(axis=0)) + 2
+
+    #ref segments sorted by cell
+    refKey = np.ravel_multi_index(refCell.T, dims)
+    order = np.argsort(refKey, kind="stable")
+    refKey = refKey[order]
+
+    for start in range(0, len(query), chunk):
+        cells = queryCell[start : start + chunk]
+        for offset in itertools.product((-1, 0, 1), repeat=3):
+            c = cells + offset
+            valid = np.nonzero(np.all((c >= 0) & (c < dims), axis=1))[0]
+            key = np.ravel_multi_index(c[valid].T, dims)
+            low = np.searchsorted(refKey, key, "left")
+            counts = np.searchsorted(refKey, key, "right") - low
+            if not counts.any():
+                continue
+            #all (query, ref) pairs of the cell
+            queryIndex = start + np.repeat(valid, counts)
+            firstPair = np.cumsum(counts) - counts
+            refIndex = order[np.repeat(low, counts) +
+                    np.arange(counts.sum()) - np.repeat(firstPair, counts)]
+            d = segmentDistance(query[queryIndex], ref[refIndex])
+            close = d <= radius
+            queryIndices.append(queryIndex[close])
+            refIndices.append(refIndex[close])
+            distances.append(d[close])
+
+    return np.concatenate(queryIndices), np.concatenate(refIndices), \
+            np.concatenate(distances)
+
+def matchSegments( first, second, radius:float ):
+    '''
+    One to one matching of the segments of first and second,
+    closest pairs first, pairs farther than radius excluded.
+    Return for each segment of first the segmentDistance to its
+    match, inf if none, and whether each segment of second
+    is matched.
+
+    Each round matches the pairs that are the closest pair of
+    both their segments, ties broken by index: the closest
+    remaining pair always is one of them.
+    '''
+    import numpy as np
+
+    q, r, d = candidatePairs(first, second, radius)
+    firstDist = np.full(len(first), np.inf)
+    secondMatched = np.zeros(len(second), dtype=bool)
+    while len(d):
+        #closest pair of each query, then of each ref segment
+        order = np.lexsort((r, d, q))
+        bestOfQuery = np.zeros(len(d), dtype=bool)
+        bestOfQuery[order[np.r_[True, q[order][1:] != q[order][:-1]]]] = True
+        order = np.lexsort((q, d, r))
+        bestOfRef = np.zeros(len(d), dtype=bool)
+        bestOfRef[order[np.r_[True, r[order][1:] != r[order][:-1]]]] = True
+
+        mutual = bestOfQuery & bestOfRef
+        firstDist[q[mutual]] = d[mutual]
+        secondMatched[r[mutual]] = True
+        left = np.isinf(firstDist[q]) & ~secondMatched[r]
+        q, r, d = q[left], r[left], d[left]
+    return firstDist, secondMatched
+
+def compareToolpaths( first, second, tolerance:float, displacement:float ):
+    '''
+    Compare the segments of first and second, arrays of shape (n, 2, 3),
+    each segment being matched to at most one of the other toolpath
+    (see matchSegments): duplicated or dropped segments are
+    reported as extra or missing.
+    Return a list of (layer Z, first count, second count, matched,
+    displaced, missing, extra), one entry per layer.
+    '''
+    import numpy as np
+
+    radius = max(tolerance, displacement)
+    firstDist, secondMatched = matchSegments(first, second, radius)
+
+    #layers from the midpoints, rounded to a micron
+    firstZ = np.round(first[:, :, 2].mean(axis=1), 3)
+    secondZ = np.round(second[:, :, 2].mean(axis=1), 3)
+    layers = np.union1d(firstZ, secondZ)
+
+    count = lambda z, mask : np.bincount(np.searchsorted(layers, z[mask]),
+            minlength=len(layers))
+    report = zip(layers.tolist(),
+            count(firstZ, slice(None)).tolist(),
+            count(secondZ, slice(None)).tolist(),
+            count(firstZ, firstDist <= tolerance).tolist(),
+            count(firstZ, (firstDist > tolerance) &
+                (firstDist <= displacement)).tolist(),
+            count(firstZ, np.isinf(firstDist)).tolist(),
+            count(secondZ, ~secondMatched).tolist())
+    return list(report)
+
+def main(argv=None):
+    '''
+    Command line entry point. argv defaults to sys.argv[1:].
+    Logging is configured by the caller.
+    Return 1 if the toolpaths differ.
+    '''
+    parser = argparse.ArgumentParser(description=
+            "Compare two toolpaths, .gcode or .CLI, segment by segment.")
+    parser.add_argument('first', help="Path of the reference toolpath.")
+    parser.add_argument('second', help="Path of the compared toolpath.")
+    parser.add_argument('--tolerance', type=float, default=1e-3,
+            help="Largest endpoint distance of matching segments, [mm].")
+    parser.add_argument('--displacement', type=float, default=0.4,
+            help="Largest endpoint distance of displaced segments, [mm].")
+    parser.add_argument('-a', '--all', action='store_true',
+            help="Report all layers, not only those with differences.")
+
+    args = parser.parse_args(argv)
+
+    logging.info("Comparing {} to {}".format(args.first, args.second))
+    report = compareToolpaths(readToolpath(args.first),
+            readToolpath(args.second), args.tolerance, args.displacement)
+
+    header = ("layer Z", "first", "second", "matched",
+            "displaced", "missing", "extra")
+    print(("{:>10}"*len(header)).format(*header))
+    totals = [0]*6
+    for row in report:
+        totals = [ t + r for t, r in zip(totals, row[1:]) ]
+        if args.all or any(row[4:]):
+            print(("{:>10.3f}" + "{:>10}"*6).format(*row))
+    print(("{:>10}"*len(header)).format("total", *totals))
+
+    if any(totals[3:]):
+        return 1
+    return 0
+
+if __name__=="__main__":
+    #log file settings
+    logging.basicConfig(filename="logfile", level=logging.INFO,
+            format="%(levelname)s:%(message)s")
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+    sys.exit(main())
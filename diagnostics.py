@@ -0,0 +1,99 @@
+'''
+Report of the malformed lines skipped by the readers in lenient mode.
+
+The readers run their line loop inside a single try block: a clean
+file never enters the error handling, which only resumes the loop
+after recording the line. Byte offsets are computed once the file
+is read, and only if there were errors.
+'''
+
+from array import array
+
+class errorReport:
+    '''
+    Malformed lines of a file, in compact arrays:
+        lineNumbers:    line number, from 1, of each error
+        offsets:        byte offset of the start of each line,
+                        filled by locate
+        messages:       index in kinds of each error
+        kinds:          distinct error messages, at most maxKinds,
+                        further ones only by their exception type
+    Only the text of the first maxExamples lines recorded is kept.
+    Offsets are -1 until located.
+    '''
+    def __init__(self, maxExamples=20, maxKinds=50):
+        self.lineNumbers = array('q')
+        self.offsets = array('q')
+        self.messages = array('i')
+        self.kinds = []
+        self.kindIndex = {}
+        self.examples = {}
+        self.maxExamples = maxExamples
+        self.maxKinds = maxKinds
+
+    def __len__(self):
+        return len(self.lineNumbers)
+
+    def add(self, lineIndex:int, line:str, error:Exception):
+        '''
+        Record the error raised by the line of index lineIndex, from 0.
+        '''
+        message = "{}: {}".format(type(error).__name__,
+                " ".join(str(error).split()))
+        if message not in self.kindIndex and \
+                len(self.kinds) >= self.maxKinds:
+            message = type(error).__name__
+        if message not in self.kindIndex:
+            self.kindIndex[message] = len(self.kinds)
+            self.kinds.append( message )
+        self.lineNumbers.append( lineIndex + 1 )
+        self.messages.append( self.kindIndex[message] )
+        if len(self.examples) < self.maxExamples:
+            self.examples[lineIndex + 1] = line.rstrip("\n")[0:80]
+
+    def locate(self, raw:bytes, block=2**20):
+        '''
+        Byte offsets of the recorded lines in raw, the content of
+        the file as bytes: offsets count the line endings as they
+        are in the file, e.g. CRLF, which text mode turns into LF.
+        Errors are sorted by line number.
+        '''
+        order = sorted(range(len(self)), key=self.lineNumbers.__getitem__)
+        self.lineNumbers = array('q', (self.lineNumbers[i] for i in order))
+        self.messages = array('i', (self.messages[i] for i in order))
+
+        offsets = array('q')
+        #start of line number line
+        pos, line = 0, 1
+        for n in self.lineNumbers:
+            #skip blocks of lines, counted in C, then line by line
+            while line < n and 0 <= pos < len(raw) - block:
+                k = raw.count(b"\n", pos, pos + block)
+                if line + k >= n:
+                    break
+                pos, line = pos + block, line + k
+            while line < n and pos >= 0:
+                pos = raw.find(b"\n", pos)
+                pos, line = (pos + 1, line + 1) if pos >= 0 else (-1, n)
+            offsets.append( pos )
+        self.offsets = offsets
+
+    def print(self, name=""):
+        '''
+        Number of errors of each kind and the first
+        maxExamples malformed lines.
+        '''
+        counts = [0]*len(self.kinds)
+        for m in self.messages:
+            counts[m] += 1
+        print("")
+        print("Malformed lines skipped{}: {}".format(
+            " in " + name if name else "", len(self)))
+        for kind, count in zip(self.kinds, counts):
+            print("{:>10}  {}".format(count, kind))
+        print(("{:>10}"*2 + "  {}").format("line", "offset", "text"))
+        offsets = self.offsets or array('q', [-1]*len(self))
+        for n, o in zip(self.lineNumbers, offsets):
+            if n in self.examples:
+                print(("{:>10}"*2 + "  {}").format(n, o, self.examples[n]))
+        print("")
@@ -5,160 +5,21 @@ Converts gcode in ASCII format to CLI
 '''
 
 import os
-import re
 import sys
 import argparse
 import logging
 
-'''
-Utilities to read Gcode lines into Python data structures.
-gcode lines are stored into dictionnaries with each key corresponding
-to a token that was detected in said line.
-'''
-
-def readGcodeLine(line):
-    '''
-    Parse a Gcode line and return the tokens that were
-    understood in a dictionnary. Do nothing to tokens that
-    were not understood. Based on regexp.
-
-    line is a string containing a Gcode line.
-    '''
-    typeOfLinePattern = r"^(;)|([G]\d+)"
-
-    #the pipe is a regex "or"
-    coordinatePattern = r"[XYZE](([+-]?)"\
-            + r"(((\d+)(\.\d+)?)"\
-            + r"|([+-]?(\d*)(\.\d+))))"
-    #potential concern here: will match XYZE followed by nothing.
-    #will crash later in that case
-
-    typeOfLineMatch   = re.search(typeOfLinePattern, line)
-
-    ##Initialize output dictionnary
-    output = {}
-
-    #Check type of line:
-    ##If a re.match does not find anything, the returned type is
-    ##none, which does not have a "group" method.
-    if isinstance(typeOfLineMatch, re.Match):
-        if (typeOfLineMatch.group(0)[0]==";"):
-            output["type"] = "comment"
-            return output
-        else:
-            output["type"] = typeOfLineMatch.group(0)
-    else:
-        #logging.warning("Type of line not detected:%s", line)
-        output["type"] = "unknown"
-
-    coordinateMatches = re.finditer(coordinatePattern, line)
-    #Process coordinate matches
-    for match in coordinateMatches:
-        #determine axis of coordinate
-        fullMatch = match.group(0)
-        if fullMatch[0]=="F":
-            output["F"] = float(match.group(1))
-        if fullMatch[0]=="X":
-            output["X"] = float(match.group(1))
-        elif fullMatch[0]=="Y":
-            output["Y"] = float(match.group(1))
-        elif fullMatch[0]=="Z":
-            output["Z"] = float(match.group(1))
-        elif fullMatch[0]=="E":
-            output["E"] = float(match.group(1))
-    return output
-
-def hasCoordinate( gcodeLine ):
-    '''
-    Determine if the gcode line contains spatial information.
-    '''
-    if 'X' in gcodeLine or 'Y' in gcodeLine or 'Z' in gcodeLine:
-        return True
-    else:
-        return False
-
-def hasExtrusion( gcodeLine ):
-    '''
-    Determines if the gcode line describes extrusion.
-    '''
-    if hasCoordinate( gcodeLine ) and 'E' in gcodeLine:
-        if gcodeLine['E'] > 0:
-            return True
-    else:
-        return False
-
-def getPoint( gcodeLine, currPoint ):
-    '''
-    Determines if the gcode line describes a new point.
-    '''
-    x, y, z = currPoint
-    hasPoint = False
-    if 'X' in gcodeLine:
-        #update X
-        x = gcodeLine['X']
-        hasPoint = True
-    if 'Y' in gcodeLine:
-        #update Y
-        y = gcodeLine['Y']
-        hasPoint = True
-    if 'Z' in gcodeLine:
-        #update Z:
-        z = gcodeLine['Z']
-        hasPoint = True
-    if hasPoint:
-        return (x, y, z)
-    else:
-        return ()
-
-def readGcodeFile(File):
-    '''
-    Read Gcode file and stores lines with extrusion.
-
-    File is a string with the path to the gcode file.
-    segmentList will be a list of entries with 2 entries in R3,
-    corresponding to the lines with extrusion in File.
-    '''
-    #initialize two empty dictionnaries for
-    #the previous line and the current line
-    currLine = {}
-    #initialize segmentList to empty list
-    pointList = []
-    connectivity = []
-    with open(File, 'r') as FileHandle:
-        lines = FileHandle.readlines()
-
-        prevPoint = (0.0, 0.0, 0.0)
-        currPoint = (0.0, 0.0, 0.0)
-
-        #read lines
-        for line in lines:
-
-            currLine = readGcodeLine( line )
-
-            if currLine["type"] == "comment":
-                continue
-
-            #contains a point?
-            newPoint = getPoint(currLine, currPoint)
-            if newPoint:
-                prevPoint = currPoint
-                currPoint = newPoint
-
-            #if line has extrusion, store the associated segment and points
-            if hasExtrusion(currLine):
-                #add the previously read point only
-                #if it isn't the equal to the last point added.
-                if pointList:
-                    if prevPoint != pointList[-1]:
-                        pointList.append( prevPoint )
-                else:
-                    pointList.append( prevPoint )
-
-                pointList.append( currPoint )
-                #zero indexing
-                connectivity.append( (len(pointList)-2, len(pointList)-1) )
-
-        return pointList, connectivity
+#the gcode reader is shared with gcode2vtk,
+#bboxer lives at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "gcode2vtk"))
+from gcode2vtk import readGcodeFile, splitShards, writeShards, \
+        addShardArguments
+from bboxer import addRegionArguments, regionFromArguments, openOutput
+from diagnostics import errorReport
+from meshData import segmentPoints
 
 def write2CLI( path2gcode,
         pointList, connectivity, shifting=True):
@@ -166,16 +27,16 @@ def write2CLI( path2gcode,
     Write the contents of
         pointList and
         connectivity
-    to a CLI file path2CLI
+    to a CLI file path2CLI, a path or an opened text file
     '''
     #initialize extrusion axis to 0.0 and current Z to impossible value
     E = 0.0
     currZ = -1
-    with open( path2gcode, 'w' ) as f:
-        for line in connectivity:
+    with openOutput( path2gcode ) as f:
+        for p1, p2 in segmentPoints( pointList, connectivity ):
             #get points
-            p1 = list(pointList[line[0]])
-            p2 = list(pointList[line[1]])
+            p1 = list(p1)
+            p2 = list(p2)
             #increase slightly E
             E += 0.1
             #update current Z if necessary and write Z line
@@ -194,7 +55,35 @@ def write2CLI( path2gcode,
             #write to file
             f.write( hatchLine )
 
-if __name__=="__main__":
+def write2CLIShards( path2CLI,
+        pointList, connectivity, numShards, shifting=True,
+        byLayer=False, numWorkers=None ):
+    '''
+    Write the contents of pointList and connectivity to numShards
+    CLI files (see splitShards) written in parallel, and an index
+    file listing for each of them its layer range and number
+    of hatches, path2CLI with a .index extension.
+    Returns the path of the index file.
+    '''
+    shards = splitShards( pointList, connectivity, numShards, byLayer )
+    paths = writeShards( write2CLI, path2CLI, shards, (shifting,),
+            numWorkers )
+
+    index = os.path.splitext( path2CLI )[0] + ".index"
+    with open( index, 'w' ) as f:
+        f.write( "#file firstLayer lastLayer numHatches\n" )
+        for path, (p, c) in zip(paths, shards):
+            if not c:
+                continue
+            f.write( "{} {} {} {}\n".format( os.path.basename(path),
+                p[c[0][0]][2], p[c[-1][0]][2], len(c) ) )
+    return index
+
+def main(argv=None):
+    '''
+    Command line entry point. argv defaults to sys.argv[1:].
+    Logging is configured by the caller.
+    '''
     #get commandline arguments
     parser = argparse.ArgumentParser(description=
             "Read standard .gcode and output .CLI.")
@@ -218,9 +107,27 @@ if __name__=="__main__":
                     hatches in order for origin and destination\
                     of consecutive hatches to not match.\
                     Required by COMET')
+    parser.add_argument('--arc-tolerance', type=float, default=0.01,
+            dest='arcTolerance',
+            help='Maximal distance between G2/G3 arcs and\
+                    the segments replacing them, in gcode units.')
+    parser.add_argument('--relative-extrusion', action='store_true',
+            dest='relativeExtrusion',
+            help='Start in relative extrusion mode (M83).\
+                    For files where any positive E means extrusion.')
+    parser.add_argument('--compact', action='store_true',
+            help='Store points as float32 and lines as int32\
+                    while converting, for very large files.')
+    parser.add_argument('--lenient', action='store_true',
+            help='Skip malformed lines instead of stopping,\
+                    and report them.')
+    addRegionArguments(parser)
+    addShardArguments(parser)
     parser.set_defaults( shifting=True )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not args.arcTolerance > 0:
+        parser.error("--arc-tolerance must be positive")
 
     #unpack
     path2gcode = args.path2gcode[ 0 ]
@@ -237,14 +144,29 @@ if __name__=="__main__":
         path2CLI = args.path2CLI
         path2CLI = os.path.normcase( path2CLI )
 
-    #log file settings
-    logging.basicConfig(filename="logfile", level=logging.INFO,
-            format="%(levelname)s:%(message)s")
-    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
     logging.info("Target gcode file: {}".format(path2gcode))
     logging.info("Target CLI file: {}".format(path2CLI))
 
     #run file reader and get points and connectivities
-    p, c = readGcodeFile( path2gcode )
+    errors = errorReport() if args.lenient else None
+    p, c = readGcodeFile( path2gcode, args.arcTolerance,
+            args.relativeExtrusion, regionFromArguments(args),
+            compact=args.compact, errors=errors )
+    if errors:
+        logging.warning("Skipped {} malformed lines".format(len(errors)))
+        errors.print(path2gcode)
     #run CLI writer and write to path2CLI
-    write2CLI( path2CLI, p, c, shifting)
+    if args.shards > 1:
+        index = write2CLIShards( path2CLI, p, c, args.shards, shifting,
+                args.shardBy == "layer", args.jobs or None )
+        logging.info("Wrote shards listed in: {}".format(index))
+    else:
+        write2CLI( path2CLI, p, c, shifting)
+
+if __name__=="__main__":
+    #log file settings
+    logging.basicConfig(filename="logfile", level=logging.INFO,
+            format="%(levelname)s:%(message)s")
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+    main()
@@ -4,6 +4,16 @@ import re
 import sys
 import argparse
 import logging
+import math
+from array import array
+
+#bboxer lives at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+from bboxer import gcodeBBox, addRegionArguments, regionFromArguments, \
+        openOutput
+from meshData import compactPointList, compactConnectivity
+from diagnostics import errorReport
 
 #Utilities to read Gcode lines into Python data structures.
 #gcode lines are stored into dictionnaries with each key corresponding
@@ -16,14 +26,14 @@ def readGcodeLine(line: str):
 
     line is a string containing a Gcode line.
     '''
-    typeOfLinePattern = r"^(;)|([G]\d+)"
+    typeOfLinePattern = r"^(;)|([GM]\d+)"
 
     #the pipe is a regex "or"
-    coordinatePattern = r"[XYZE](([+-]?)"\
+    coordinatePattern = r"[XYZEIJR](([+-]?)"\
             + r"(((\d+)(\.\d+)?)"\
             + r"|([+-]?(\d*)(\.\d+))))"
-    #potential concern here: will match XYZE followed by nothing.
-    #will crash later in that case
+    #axis letters followed by nothing are not matched and
+    #silently ignored, see skipBareAxes for the lenient mode
 
     typeOfLineMatch   = re.search(typeOfLinePattern, line)
 
@@ -58,13 +68,21 @@ def readGcodeLine(line: str):
             output["Z"] = float(match.group(1))
         elif fullMatch[0]=="E":
             output["E"] = float(match.group(1))
+        elif fullMatch[0]=="I":
+            output["I"] = float(match.group(1))
+        elif fullMatch[0]=="J":
+            output["J"] = float(match.group(1))
+        elif fullMatch[0]=="R":
+            output["R"] = float(match.group(1))
     return output
 
 def hasCoordinate( gcodeLine : dict ):
     '''
     Determine if the gcode line contains spatial information.
+    A full circle arc only has its center offsets I and J.
     '''
-    if 'X' in gcodeLine or 'Y' in gcodeLine or 'Z' in gcodeLine:
+    if 'X' in gcodeLine or 'Y' in gcodeLine or 'Z' in gcodeLine \
+            or 'I' in gcodeLine or 'J' in gcodeLine:
         return True
     else:
         return False
@@ -79,78 +97,511 @@ def hasExtrusion( gcodeLine: dict ):
     else:
         return False
 
-def getPoint( gcodeLine: dict, currPoint: tuple ):
+def getPoint( gcodeLine: dict, currPoint: tuple,
+        relative=False, offset=(0.0, 0.0, 0.0) ):
     '''
     Determines if the gcode line describes a new point.
+
+    In relative positioning (G91) coordinates are displacements
+    from currPoint. Otherwise they are positions, to which
+    offset, set by G92, is added.
     '''
     x, y, z = currPoint
     hasPoint = False
-    if 'X' in gcodeLine:
-        #update X
-        x = gcodeLine['X']
-        hasPoint = True
-    if 'Y' in gcodeLine:
-        #update Y
-        y = gcodeLine['Y']
-        hasPoint = True
-    if 'Z' in gcodeLine:
-        #update Z:
-        z = gcodeLine['Z']
-        hasPoint = True
+    if relative:
+        if 'X' in gcodeLine:
+            x += gcodeLine['X']
+            hasPoint = True
+        if 'Y' in gcodeLine:
+            y += gcodeLine['Y']
+            hasPoint = True
+        if 'Z' in gcodeLine:
+            z += gcodeLine['Z']
+            hasPoint = True
+    else:
+        if 'X' in gcodeLine:
+            #update X
+            x = gcodeLine['X'] + offset[0]
+            hasPoint = True
+        if 'Y' in gcodeLine:
+            #update Y
+            y = gcodeLine['Y'] + offset[1]
+            hasPoint = True
+        if 'Z' in gcodeLine:
+            #update Z:
+            z = gcodeLine['Z'] + offset[2]
+            hasPoint = True
     if hasPoint:
         return (x, y, z)
     else:
         return ()
 
-def readGcodeFile(File: str):
+#types of line changing how coordinates are read
+MODELINES = ("G90", "G91", "M82", "M83", "G92")
+#firmware retractions
+RETRACTLINES = ("G10",)
+#types of line moving the tool, homing (G28) moving to its axes,
+#lines without G or M being read as moves as well
+MOVELINES = ("G0", "G1", "G2", "G3", "G00", "G01", "G02", "G03", "G28",
+        "unknown")
+
+#types of line of clockwise and counterclockwise arcs
+CWARCS  = ("G2", "G02")
+CCWARCS = ("G3", "G03")
+
+def getArcCenter( gcodeLine: dict, startPoint: tuple, endPoint: tuple ):
     '''
-    Read Gcode file and stores lines with extrusion.
+    Center (x, y) of the G2/G3 arc described by gcodeLine,
+    going from startPoint to endPoint.
+    The center is either given by its offsets I, J to the start
+    point or by the radius R, negative for arcs longer than
+    half a circle. R cannot define a full circle: ValueError if
+    the arc ends at its start.
+    '''
+    x0, y0 = startPoint[0:2]
+    if 'R' not in gcodeLine:
+        return (x0 + gcodeLine.get('I', 0.0), y0 + gcodeLine.get('J', 0.0))
 
-    File is a string with the path to the gcode file.
+    x1, y1 = endPoint[0:2]
+    r = gcodeLine['R']
+    dx, dy = x1 - x0, y1 - y0
+    chord = math.hypot(dx, dy)
+    if chord == 0:
+        raise ValueError("arc ending at its start, R cannot define"
+                " a full circle, I and J are needed")
+    #distance from chord midpoint to center, 0 if the chord is
+    #longer than the diameter (rounding of the endpoints)
+    h = math.sqrt(max(r*r - chord*chord/4, 0.0))
+    #center is left of the chord for G3 with R > 0 and G2 with R < 0
+    if (gcodeLine["type"] in CCWARCS) == (r > 0):
+        h = -h
+    return ((x0 + x1)/2 + h*dy/chord, (y0 + y1)/2 - h*dx/chord)
+
+def tessellateArcs( arcs: list, tolerance: float ):
+    '''
+    Points between the endpoints of each arc of arcs, such that
+    the chords deviate at most tolerance from the arc.
+
+    arcs is a list of (startPoint, endPoint, center, clockwise).
+    Z is interpolated linearly, for helical arcs.
+    Returns a list with, for each arc, its list of inner points.
+    Full circles get at least 3 chords.
+    All arcs are tessellated at once with NumPy.
+    '''
+    import numpy as np
+
+    if not tolerance > 0:
+        raise ValueError("arc tolerance must be positive, not {}"
+                .format(tolerance))
+
+    start  = np.array([a[0] for a in arcs], dtype=float)
+    end    = np.array([a[1] for a in arcs], dtype=float)
+    center = np.array([a[2] for a in arcs], dtype=float)
+    clockwise = np.array([a[3] for a in arcs], dtype=bool)
+
+    #angles of the endpoints
+    v0 = start[:, 0:2] - center
+    v1 = end[:, 0:2] - center
+    radius = np.hypot(v0[:, 0], v0[:, 1])
+    a0 = np.arctan2(v0[:, 1], v0[:, 0])
+    a1 = np.arctan2(v1[:, 1], v1[:, 0])
+
+    #signed sweep, coinciding endpoints make a full circle
+    sweep = np.where(clockwise, a0 - a1, a1 - a0) % (2*np.pi)
+    sweep[sweep <= 1e-12] = 2*np.pi
+    sweep = np.where(clockwise, -sweep, sweep)
+
+    #largest angle whose chord deviates less than tolerance
+    cosine = np.clip(1.0 - tolerance / np.maximum(radius, 1e-12), -1.0, 1.0)
+    maxAngle = 2*np.arccos(cosine)
+    numChords = np.maximum(np.ceil(np.abs(sweep) /
+        np.maximum(maxAngle, 1e-12)), 1).astype(np.int64)
+    #a single chord of a full circle has zero length
+    numChords[np.abs(sweep) == 2*np.pi] = np.maximum(
+            numChords[np.abs(sweep) == 2*np.pi], 3)
+
+    #flat arrays of all inner points of all arcs
+    numInner = numChords - 1
+    arcIndex = np.repeat(np.arange(len(arcs)), numInner)
+    firstInner = np.cumsum(numInner) - numInner
+    k = np.arange(arcIndex.size) - firstInner[arcIndex] + 1
+    t = k / numChords[arcIndex]
+    angle = a0[arcIndex] + t*sweep[arcIndex]
+    points = np.empty((arcIndex.size, 3))
+    points[:, 0] = center[arcIndex, 0] + radius[arcIndex]*np.cos(angle)
+    points[:, 1] = center[arcIndex, 1] + radius[arcIndex]*np.sin(angle)
+    points[:, 2] = start[arcIndex, 2] + \
+            t*(end[arcIndex, 2] - start[arcIndex, 2])
+
+    #split back per arc
+    points = [tuple(p) for p in points.tolist()]
+    bounds = np.cumsum(numInner).tolist()
+    return [points[b - n : b] for b, n in zip(bounds, numInner.tolist())]
+
+def insertArcPoints( pointList: list, connectivity: list,
+        arcs: list, tolerance: float, region=None, extrusion=None ):
+    '''
+    Replace the chords of arcs by their tessellation.
+
+    arcs is a list of (segment index, startPoint, endPoint,
+    center, clockwise) where segment index is the position of
+    the chord in connectivity.
+    If region is given, the pieces of the arcs not crossing it
+    are dropped.
+    If extrusion, the extruded length of each segment, is given,
+    it is replaced in place, arcs sharing theirs among their
+    pieces in proportion to length.
+    Returns the new pointList and connectivity.
+    '''
+    innerPoints = tessellateArcs( [a[1:] for a in arcs], tolerance )
+    arcPoints = { a[0] : inner for a, inner in zip(arcs, innerPoints) }
+
+    #same containers as the input, compact or not
+    newPointList = type(pointList)()
+    newConnectivity = type(connectivity)()
+    lastAdded = None
+    newExtrusion = array('d')
+    for segment, (i, j) in enumerate(connectivity):
+        inner = arcPoints.get(segment)
+        if inner is None:
+            pieces = ((pointList[i], pointList[j]),)
+            if extrusion is not None:
+                newExtrusion.append( extrusion[segment] )
+        else:
+            chain = [pointList[i], *inner, pointList[j]]
+            pieces = list(zip(chain[:-1], chain[1:]))
+            if extrusion is not None:
+                lengths = [ math.dist(p1, p2) for p1, p2 in pieces ]
+                perLength = extrusion[segment] / (sum(lengths) or 1.0)
+            if region is not None:
+                kept = [ region.intersectsSegment(p1, p2)
+                        for p1, p2 in pieces ]
+                pieces = [ p for p, k in zip(pieces, kept) if k ]
+                if extrusion is not None:
+                    lengths = [ l for l, k in zip(lengths, kept) if k ]
+            if extrusion is not None:
+                newExtrusion.extend( l * perLength for l in lengths )
+        for p1, p2 in pieces:
+            #same point sharing as in readGcodeFile
+            if p1 != lastAdded:
+                newPointList.append( p1 )
+            newPointList.append( p2 )
+            lastAdded = p2
+            newConnectivity.append( (len(newPointList) - 2,
+                len(newPointList) - 1) )
+    if extrusion is not None:
+        extrusion[:] = newExtrusion
+    return newPointList, newConnectivity
+
+class travelLog:
+    '''
+    Moves without extrusion and retractions, as recorded by
+    readGcodeFile, in compact arrays of floats:
+        moves:          x1 y1 z1 x2 y2 z2 of each move
+        retractions:    Z of each retraction (decrease of E
+                        or firmware retraction G10)
+    '''
+    def __init__(self):
+        self.moves = array('d')
+        self.retractions = array('d')
+
+    def toMesh(self):
+        '''
+        Points and connectivities of the moves, for the writers.
+        '''
+        m = self.moves
+        pointList = [ tuple(m[i:i+3]) for i in range(0, len(m), 3) ]
+        connectivity = [ (i, i+1) for i in range(0, len(pointList), 2) ]
+        return pointList, connectivity
+
+    def statistics(self, numLongest=10):
+        '''
+        Summary of the moves:
+            layers:     list of (Z, number of moves, travelled distance,
+                        number of retractions), Z being the height
+                        of the end of the moves, rounded to a micron
+            longest:    list of (length, start, end) of the
+                        numLongest longest moves, longest first
+        '''
+        import numpy as np
+
+        moves = np.frombuffer(self.moves, dtype=float).reshape(-1, 6)
+        retractions = np.round(np.frombuffer(self.retractions,
+            dtype=float), 3)
+        lengths = np.linalg.norm(moves[:, 3:6] - moves[:, 0:3], axis=1)
+        z = np.round(moves[:, 5], 3)
+
+        layerZ = np.union1d(z, retractions)
+        layerIndex = np.searchsorted(layerZ, z)
+        numMoves = np.bincount(layerIndex, minlength=len(layerZ))
+        distance = np.bincount(layerIndex, weights=lengths,
+                minlength=len(layerZ))
+        numRetractions = np.bincount(np.searchsorted(layerZ, retractions),
+                minlength=len(layerZ))
+        layers = list(zip(layerZ.tolist(), numMoves.tolist(),
+            distance.tolist(), numRetractions.tolist()))
+
+        order = np.argsort(lengths)[::-1][:numLongest]
+        longest = [ (float(lengths[i]), tuple(moves[i, 0:3].tolist()),
+            tuple(moves[i, 3:6].tolist())) for i in order.tolist() ]
+        return layers, longest
+
+    def print(self, numLongest=10):
+        layers, longest = self.statistics(numLongest)
+        print("")
+        print("Travel moves:")
+        print(("{:>10}"*4).format("layer Z", "moves", "distance",
+            "retract."))
+        for layer in layers:
+            print(("{:>10.3f}{:>10}{:>10.1f}{:>10}").format(*layer))
+        print(("{:>10}{:>10}{:>10.1f}{:>10}").format("total",
+            sum(l[1] for l in layers), sum(l[2] for l in layers),
+            sum(l[3] for l in layers)))
+        print("Longest moves:")
+        for length, start, end in longest:
+            print("{:10.1f} from {} to {}".format(length, start, end))
+        print("")
+
+#axis letter not followed by a number, e.g. "G1 X Y2",
+#and start of the moves (G0 to G3) it must be found in
+bareAxisPattern = re.compile(r"[ \t][XYZEIJR](?![+-]?\.?\d)")
+movePattern = re.compile(r"[ \t]*G0*[0-3](?!\d)")
+
+def skipBareAxes( lines, errors ):
+    '''
+    Record in errors, an errorReport, the moves of lines with an
+    axis letter not followed by a number, which readGcodeLine
+    would read as a move without that axis.
+    Return lines with these lines replaced by comments.
+    The whole text is searched at once for such letters, only
+    the lines where some are found are looked at one by one.
+    '''
+    import bisect
+
+    text = "".join(lines)
+    found = [ m.start() for m in bareAxisPattern.finditer(text) ]
+    if not found:
+        return lines
+    lines = list(lines)
+    lineStarts = [0]
+    for l in lines:
+        lineStarts.append( lineStarts[-1] + len(l) )
+    for start in found:
+        lineIndex = bisect.bisect_right(lineStarts, start) - 1
+        line = lines[lineIndex]
+        comment = line.find(";")
+        if not movePattern.match(line) or (comment >= 0
+                and start - lineStarts[lineIndex] > comment):
+            continue
+        errors.add(lineIndex, line, ValueError("axis without value"))
+        lines[lineIndex] = ";"
+    return lines
+
+def readGcodeLines(lines, arcTolerance=0.01, relativeExtrusion=False,
+        region=None, travel=None, extrusion=None, compact=False,
+        errors=None):
+    '''
+    Read Gcode lines and stores lines with extrusion.
+
+    lines is an iterable of the lines of a gcode file.
     segmentList will be a list of entries with 2 entries in R3,
-    corresponding to the lines with extrusion in File.
+    corresponding to the lines with extrusion in lines.
+    G2/G3 arcs are split in segments deviating at most
+    arcTolerance from the arc.
+    Absolute (G90, M82) and relative (G91, M83) positioning and
+    extrusion are followed, as well as position resets (G92).
+    A line extrudes if it moves and increases E. Only moves
+    (G0 to G3, see MOVELINES) and G92 change the position and E,
+    e.g. the E of M92 or M201 is not a position.
+    As in Marlin, Klipper and RepRapFirmware, G91 also makes E
+    relative and G90 returns E to the mode of M82/M83, e.g. a
+    G91/G90 Z lift keeps an M83 file in relative extrusion.
+    relativeExtrusion sets the extrusion mode until the first
+    M82/M83: files that use E as a flag, any positive E
+    meaning extrusion, are read with relativeExtrusion=True.
+    Points are stored in machine coordinates, i.e. with
+    G92 offsets removed.
+    If region, a gcodeBBox, is given, only the segments crossing
+    it are stored.
+    If travel, a travelLog, is given, the moves without extrusion
+    (as chords for arcs) and the retractions are added to it.
+    If extrusion, an array('d'), is given, the extruded length of
+    each segment is appended to it.
+    If compact, points and lines are stored as float32 and int32
+    in a compactPointList and a compactConnectivity (see meshData).
+    If errors, an errorReport, is given, malformed lines are
+    recorded in it and skipped instead of raising.
     '''
     #initialize two empty dictionnaries for
     #the previous line and the current line
     currLine = {}
     #initialize segmentList to empty list
-    pointList = []
-    connectivity = []
-    with open(File, 'r') as FileHandle:
-        lines = FileHandle.readlines()
+    if compact:
+        pointList = compactPointList()
+        connectivity = compactConnectivity()
+    else:
+        pointList = []
+        connectivity = []
+    #last point added to pointList
+    lastAdded = None
+    #arcs with extrusion, tessellated once the whole file is read
+    arcs = []
+    prevPoint = (0.0, 0.0, 0.0)
+    currPoint = (0.0, 0.0, 0.0)
+
+    #positioning and extrusion modes, the extruder mode
+    #being the one of M82/M83, which G90 returns to
+    relativePositioning = False
+    extruderRelative = relativeExtrusion
+    #G92 offsets between machine and gcode coordinates
+    offset = (0.0, 0.0, 0.0)
+    #extrusion axis, in gcode coordinates
+    currE = 0.0
+
+    if errors is not None:
+        lines = skipBareAxes(lines, errors)
 
-        prevPoint = (0.0, 0.0, 0.0)
-        currPoint = (0.0, 0.0, 0.0)
+    #read lines
+    #errors are handled outside of the loop, which resumes
+    #on the shared iterator after the malformed line
+    lineIter = enumerate(lines)
+    while True:
+        try:
+            for lineIndex, line in lineIter:
 
-        #read lines
-        for line in lines:
+                currLine = readGcodeLine( line )
 
-            currLine = readGcodeLine( line )
+                if currLine["type"] == "comment":
+                    continue
 
-            if currLine["type"] == "comment":
-                continue
+                if currLine["type"] in MODELINES:
+                    lineType = currLine["type"]
+                    if lineType == "G90":
+                        relativePositioning = False
+                        relativeExtrusion = extruderRelative
+                    elif lineType == "G91":
+                        relativePositioning = True
+                        relativeExtrusion = True
+                    elif lineType == "M82":
+                        relativeExtrusion = extruderRelative = False
+                    elif lineType == "M83":
+                        relativeExtrusion = extruderRelative = True
+                    else:
+                        #G92 without axes resets all of them
+                        if not ('X' in currLine or 'Y' in currLine
+                                or 'Z' in currLine or 'E' in currLine):
+                            currLine.update(X=0.0, Y=0.0, Z=0.0, E=0.0)
+                        #new offset = machine position - gcode position
+                        offset = tuple( currPoint[i] - currLine[axis]
+                                if axis in currLine else offset[i]
+                                for i, axis in enumerate("XYZ") )
+                        currE = currLine.get('E', currE)
+                    continue
 
-            #contains a point?
-            newPoint = getPoint(currLine, currPoint)
-            if newPoint:
-                prevPoint = currPoint
-                currPoint = newPoint
+                if currLine["type"] in RETRACTLINES:
+                    #G10 with coordinates being a tool offset instead
+                    if travel is not None and not hasCoordinate(currLine):
+                        travel.retractions.append( currPoint[2] )
+                    continue
 
-            #if line has extrusion, store the associated segment and points
-            if hasExtrusion(currLine):
-                #add the previously read point only
-                #if it isn't the equal to the last point added.
-                if pointList:
-                    if prevPoint != pointList[-1]:
+                #other types, e.g. M92 or M201 with an E value,
+                #set parameters and leave the position and E alone
+                if currLine["type"] not in MOVELINES:
+                    continue
+
+                #contains a point?
+                newPoint = getPoint(currLine, currPoint,
+                        relativePositioning, offset)
+                isArc = currLine["type"] in CWARCS \
+                        or currLine["type"] in CCWARCS
+                if isArc and not newPoint:
+                    #full circle
+                    newPoint = currPoint
+                if newPoint:
+                    prevPoint = currPoint
+                    currPoint = newPoint
+
+                #extruded length
+                deltaE = 0.0
+                if 'E' in currLine:
+                    if relativeExtrusion:
+                        deltaE = currLine['E']
+                        currE += deltaE
+                    else:
+                        deltaE = currLine['E'] - currE
+                        currE = currLine['E']
+
+                #if line has extrusion, store the associated segment
+                #and points, arcs are clipped to the region once tessellated
+                extrudes = deltaE > 0 and hasCoordinate(currLine)
+                if extrudes and (region is None or isArc
+                        or region.intersectsSegment(prevPoint, currPoint)):
+                    #center first: a bad arc adds nothing
+                    if isArc:
+                        try:
+                            center = getArcCenter(currLine, prevPoint,
+                                    currPoint)
+                        except ValueError as e:
+                            if errors is not None:
+                                raise
+                            raise ValueError("line {}: {}".format(
+                                lineIndex + 1, e)) from None
+                    #add the previously read point only
+                    #if it isn't the equal to the last point added.
+                    if prevPoint != lastAdded:
                         pointList.append( prevPoint )
-                else:
-                    pointList.append( prevPoint )
 
-                pointList.append( currPoint )
-                #zero indexing
-                connectivity.append( (len(pointList)-2, len(pointList)-1) )
+                    pointList.append( currPoint )
+                    lastAdded = currPoint
+                    #zero indexing
+                    connectivity.append( (len(pointList)-2,
+                        len(pointList)-1) )
+                    if extrusion is not None:
+                        extrusion.append( deltaE )
 
-        return pointList, connectivity
+                    if isArc:
+                        arcs.append( (len(connectivity)-1, prevPoint,
+                            currPoint, center, currLine["type"] in CWARCS) )
+
+                elif travel is not None and not extrudes:
+                    #E decrease
+                    if deltaE < 0:
+                        travel.retractions.append( currPoint[2] )
+                    if newPoint and prevPoint != currPoint and (
+                            region is None or
+                            region.intersectsSegment(prevPoint, currPoint)):
+                        travel.moves.extend( prevPoint + currPoint )
+            break
+        except Exception as e:
+            if errors is None:
+                raise
+            errors.add(lineIndex, line, e)
+
+    if arcs:
+        pointList, connectivity = insertArcPoints(pointList,
+                connectivity, arcs, arcTolerance, region, extrusion)
+
+    return pointList, connectivity
+
+def readGcodeFile(File: str, arcTolerance=0.01, relativeExtrusion=False,
+        region=None, travel=None, extrusion=None, compact=False,
+        errors=None):
+    '''
+    Read Gcode file and stores lines with extrusion.
+
+    File is a string with the path to the gcode file.
+    See readGcodeLines for the other arguments. The errors
+    are located in File by their byte offsets.
+    '''
+    with open(File, 'r') as FileHandle:
+        lines = FileHandle.readlines()
+
+    pointList, connectivity = readGcodeLines(lines, arcTolerance,
+            relativeExtrusion, region, travel, extrusion, compact, errors)
+    if errors:
+        with open(File, 'rb') as FileHandle:
+            errors.locate(FileHandle.read())
+    return pointList, connectivity
 
 def write2TxtFile( file:str,
         pointList: list[tuple], connectivity: list[tuple]):
@@ -177,14 +628,41 @@ def write2TxtFile( file:str,
             f.write( str(l)[1:-1] + "\n" )
     return
 
+def writeCompactPoints( f, pointList, scaling, chunk=100000 ):
+    '''
+    Write the points of a compactPointList as write2VtkFile does,
+    one per line, scaled.
+    '''
+    import numpy as np
+
+    for start in range(0, len(pointList), chunk):
+        points = scaling * np.asarray(pointList[start:start+chunk])
+        f.write( "".join( "{!r} {!r} {!r}\n".format(*p)
+            for p in points.tolist() ) )
+
+def writeCompactLines( f, connectivity, chunk=100000 ):
+    '''
+    Write the lines of a compactConnectivity as write2VtkFile does.
+    '''
+    lines = connectivity.toArray()
+    for start in range(0, len(lines), chunk):
+        f.write( "".join( "2 %d %d\n" % tuple(l)
+            for l in lines[start:start+chunk].tolist() ) )
+
 def write2VtkFile( file:str,
-        pointList: list[tuple], connectivity: list[tuple], scaling=1e-3):
+        pointList: list[tuple], connectivity: list[tuple], scaling=1e-3,
+        cellData=None):
     '''
     Write points and connectivities to .txt
+    cellData is an optional dictionnary of name: list with
+    one value per line, written as scalars.
+    Compact containers (see meshData) are formatted from their
+    arrays, in chunks, without building a tuple per point.
+    file is a path or an opened text file.
     '''
     numPoints = len(pointList)
     numLines = len(connectivity)
-    with open(file, 'w') as f:
+    with openOutput(file) as f:
         #write header
         f.write("# vtk DataFile Version 2.0\n")
         #write title
@@ -195,6 +673,9 @@ def write2VtkFile( file:str,
         f.write("DATASET POLYDATA\n")
         ##points
         f.write("POINTS " + str(numPoints) + " float\n")
+        if isinstance(pointList, compactPointList):
+            writeCompactPoints( f, pointList, scaling )
+            pointList = ()
         for p in pointList:
             #scaling, the output is a list
             p = [scaling * x for x in p]
@@ -203,19 +684,287 @@ def write2VtkFile( file:str,
             f.write( tmp + "\n" )
         ##lines
         f.write("LINES " + str(numLines) + " " + str(3*numLines) + "\n")
+        if isinstance(connectivity, compactConnectivity):
+            writeCompactLines( f, connectivity )
+            connectivity = ()
         for l in connectivity:
             #write the tuple without its parentheses and commas
             tmp = "2 " + re.sub( r"[,()]", "", str(l))
             f.write( tmp + "\n" )
+        ##attributes
+        if cellData:
+            f.write("CELL_DATA " + str(numLines) + "\n")
+        for name, values in (cellData or {}).items():
+            f.write("SCALARS " + name + " float 1\n")
+            f.write("LOOKUP_TABLE default\n")
+            f.write("\n".join( repr(v) for v in values ) + "\n")
     return
 
+def layerHeightOf( pointList: list, connectivity: list,
+        default=gcodeBBox.layerHeight ):
+    '''
+    Layer height of a toolpath: the median spacing of the distinct
+    Z of its horizontal segments, rounded to a micron, which ignores
+    a thicker first layer and helical or spiral moves. default if
+    there is a single layer.
+    '''
+    import numpy as np
+
+    points = np.asarray(pointList, dtype=float).reshape(-1, 3)
+    lines = np.asarray(connectivity, dtype=np.int64).reshape(-1, 2)
+    z = np.round(points[lines, 2], 3)
+    z = np.unique(z[z[:, 0] == z[:, 1], 0])
+    if len(z) < 2:
+        return default
+    return float(np.round(np.median(np.diff(z)), 3))
+
+def beadWidths( pointList: list, connectivity: list, extrusion,
+        filamentDiam=1.75, layerHeight=0.2 ):
+    '''
+    Width of the bead deposited by each segment, from its
+    extruded length (see readGcodeFile).
+
+    The cross section of the bead is a rectangle of height
+    layerHeight with half discs on its sides, its area being
+    the extruded volume of filament over the segment length.
+    Returns a NumPy array, 0 for segments of length 0.
+    '''
+    import numpy as np
+
+    points = np.asarray(pointList, dtype=float).reshape(-1, 3)
+    lines = np.asarray(connectivity, dtype=np.int64).reshape(-1, 2)
+    lengths = np.linalg.norm(points[lines[:, 1]] - points[lines[:, 0]],
+            axis=1)
+    volume = np.asarray(extrusion, dtype=float) * np.pi * filamentDiam**2 / 4
+    area = np.divide(volume, lengths, out=np.zeros_like(lengths),
+            where=lengths > 0)
+    widths = area / layerHeight + layerHeight * (1 - np.pi/4)
+    widths[lengths == 0] = 0.0
+    return widths
+
+def write2VtkBeads( file:str,
+        pointList: list[tuple], connectivity: list[tuple], widths,
+        layerHeight=0.2, shape="hex", scaling=1e-3 ):
+    '''
+    Write the beads of the segments to a binary .vtk file, with
+    their widths as cell data.
+
+    A bead is the box of the given width centered on its segment
+    in XY and going from layerHeight below it up to it: one
+    hexahedron (shape="hex") or, for shape="quad", one quad at
+    mid height.
+    '''
+    import numpy as np
+
+    points = np.asarray(pointList, dtype=float).reshape(-1, 3)
+    lines = np.asarray(connectivity, dtype=np.int64).reshape(-1, 2)
+    p1 = points[lines[:, 0]]
+    p2 = points[lines[:, 1]]
+    widths = np.asarray(widths, dtype=float)
+
+    #half width vector normal to the segments in XY
+    direction = p2[:, 0:2] - p1[:, 0:2]
+    norm = np.linalg.norm(direction, axis=1)
+    normal = np.zeros_like(p1)
+    normal[:, 0] = -direction[:, 1]
+    normal[:, 1] = direction[:, 0]
+    normal *= np.divide(widths / 2, norm, out=np.zeros_like(norm),
+            where=norm > 0)[:, None]
+    up = np.array([0.0, 0.0, layerHeight])
+
+    if shape == "hex":
+        #bottom face counterclockwise seen from above, then top face
+        bottom1, bottom2 = p1 - up, p2 - up
+        corners = [bottom1 - normal, bottom2 - normal,
+                bottom2 + normal, bottom1 + normal,
+                p1 - normal, p2 - normal, p2 + normal, p1 + normal]
+        dataset, cellsKeyword, cellType = "UNSTRUCTURED_GRID", "CELLS", 12
+    else:
+        middle1, middle2 = p1 - up/2, p2 - up/2
+        corners = [middle1 - normal, middle2 - normal,
+                middle2 + normal, middle1 + normal]
+        dataset, cellsKeyword, cellType = "POLYDATA", "POLYGONS", None
+
+    numCorners = len(corners)
+    numCells = len(lines)
+    #corners of a bead are consecutive points
+    beadPoints = np.stack(corners, axis=1).reshape(-1, 3)
+    cells = np.empty((numCells, numCorners + 1), dtype=">i4")
+    cells[:, 0] = numCorners
+    cells[:, 1:] = np.arange(numCells * numCorners).reshape(numCells, -1)
+
+    with open(file, 'wb') as f:
+        f.write(b"# vtk DataFile Version 2.0\n")
+        f.write(b"Gcode beads\n")
+        f.write(b"BINARY\n")
+        f.write("DATASET {}\n".format(dataset).encode())
+        f.write("POINTS {} float\n".format(len(beadPoints)).encode())
+        f.write((scaling * beadPoints).astype(">f4").tobytes())
+        f.write("\n{} {} {}\n"
+                .format(cellsKeyword, numCells, cells.size).encode())
+        f.write(cells.tobytes())
+        if cellType is not None:
+            f.write("\nCELL_TYPES {}\n".format(numCells).encode())
+            f.write(np.full(numCells, cellType, dtype=">i4").tobytes())
+        f.write("\nCELL_DATA {}\n".format(numCells).encode())
+        f.write(b"SCALARS width float 1\n")
+        f.write(b"LOOKUP_TABLE default\n")
+        f.write((scaling * widths).astype(">f4").tobytes())
+        f.write(b"\n")
+    return
+
+def splitShards( pointList: list, connectivity: list, numShards: int,
+        byLayer=False ):
+    '''
+    Split points and connectivities in at most numShards parts of
+    about the same number of points, keeping their order.
+    If byLayer, parts end where Z changes, so that each layer is
+    in a single part.
+    Returns a list of (pointList, connectivity) with
+    connectivities renumbered from 0.
+    '''
+    import bisect
+
+    if not connectivity:
+        return [ ([], []) ]
+    numSegments = len(connectivity)
+    #readers append points in order, the first points of the
+    #segments are sorted: cut at equal fractions of the points
+    firstPoints = [ l[0] for l in connectivity ]
+    bounds = [ bisect.bisect_left(firstPoints,
+        round(k * len(pointList) / numShards))
+        for k in range(1, numShards) ]
+    if byLayer:
+        #first segment of each layer but the first one
+        layerStarts = [ i for i in range(1, numSegments)
+                if pointList[connectivity[i][0]][2]
+                != pointList[connectivity[i-1][0]][2] ]
+        bounds = [ layerStarts[bisect.bisect_left(layerStarts, b)]
+                for b in bounds if b <= (layerStarts or [0])[-1] ]
+    bounds = sorted(set([0, *bounds, numSegments]))
+
+    shards = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        lines = connectivity[start:end]
+        #readers append points in order: a shard uses a range of them
+        first = min(min(l) for l in lines)
+        last = max(max(l) for l in lines)
+        renumbered = type(connectivity)()
+        renumbered.extend( (l[0] - first, l[1] - first) for l in lines )
+        shards.append( (pointList[first:last+1], renumbered) )
+    return shards
+
+def shardPath( file: str, shardIndex: int ):
+    '''
+    Path of a shard of file: part.vtk -> part.00012.vtk
+    '''
+    head, ext = os.path.splitext( file )
+    return "{}.{:05d}{}".format( head, shardIndex, ext )
+
+def writeShards( writer, file: str, shards: list, writerArgs=(),
+        numWorkers=None ):
+    '''
+    Write each (pointList, connectivity) of shards with
+    writer(path, pointList, connectivity, *writerArgs),
+    concurrently in a process pool, to the paths of shardPath.
+    Returns the list of paths.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    paths = [ shardPath( file, i ) for i in range(len(shards)) ]
+    with ProcessPoolExecutor( numWorkers ) as pool:
+        futures = [ pool.submit( writer, path, p, c, *writerArgs )
+                for path, (p, c) in zip(paths, shards) ]
+        for future in futures:
+            future.result()
+    return paths
+
+def write2VtpFile( file:str,
+        pointList: list[tuple], connectivity: list[tuple], scaling=1e-3):
+    '''
+    Write points and connectivities to an ASCII VTK XML PolyData
+    file, .vtp, the format of the pieces of ParaView collections.
+    Compact containers are formatted from their arrays, as in
+    write2VtkFile.
+    '''
+    with openOutput(file) as f:
+        f.write('<?xml version="1.0"?>\n')
+        f.write('<VTKFile type="PolyData" version="0.1">\n')
+        f.write('  <PolyData>\n')
+        f.write('    <Piece NumberOfPoints="{}" NumberOfVerts="0"'
+                ' NumberOfLines="{}" NumberOfStrips="0" NumberOfPolys="0">\n'
+                .format(len(pointList), len(connectivity)))
+        ##points
+        f.write('      <Points>\n')
+        f.write('        <DataArray type="Float32" NumberOfComponents="3"'
+                ' format="ascii">\n')
+        if isinstance(pointList, compactPointList):
+            writeCompactPoints( f, pointList, scaling )
+            pointList = ()
+        for p in pointList:
+            f.write( " ".join( repr(scaling * x) for x in p ) + "\n" )
+        f.write('        </DataArray>\n')
+        f.write('      </Points>\n')
+        ##lines, as point indices and the end of each line
+        f.write('      <Lines>\n')
+        f.write('        <DataArray type="Int32" Name="connectivity"'
+                ' format="ascii">\n')
+        if isinstance(connectivity, compactConnectivity):
+            lines = connectivity.toArray()
+            for start in range(0, len(lines), 100000):
+                f.write( "".join( "%d %d\n" % tuple(l)
+                    for l in lines[start:start+100000].tolist() ) )
+        else:
+            for l in connectivity:
+                f.write( "{} {}\n".format(*l) )
+        f.write('        </DataArray>\n')
+        f.write('        <DataArray type="Int32" Name="offsets"'
+                ' format="ascii">\n')
+        f.write( "".join( "{}\n".format(2*(i+1))
+            for i in range(len(connectivity)) ) )
+        f.write('        </DataArray>\n')
+        f.write('      </Lines>\n')
+        f.write('    </Piece>\n')
+        f.write('  </PolyData>\n')
+        f.write('</VTKFile>\n')
+
+def write2VtkShards( file:str,
+        pointList: list[tuple], connectivity: list[tuple], numShards: int,
+        scaling=1e-3, byLayer=False, numWorkers=None ):
+    '''
+    Write points and connectivities to numShards .vtp files
+    (see splitShards and write2VtpFile) written in parallel,
+    and a ParaView collection file listing them, file with
+    a .pvd extension: part.vtk -> part.pvd, part.00012.vtp.
+    ParaView only reads XML pieces in collections, hence .vtp.
+    Returns the path of the .pvd file.
+    '''
+    shards = splitShards( pointList, connectivity, numShards, byLayer )
+    vtp = os.path.splitext( file )[0] + ".vtp"
+    paths = writeShards( write2VtpFile, vtp, shards, (scaling,),
+            numWorkers )
+
+    pvd = os.path.splitext( file )[0] + ".pvd"
+    with open(pvd, 'w') as f:
+        f.write('<?xml version="1.0"?>\n')
+        f.write('<VTKFile type="Collection" version="0.1">\n')
+        f.write('  <Collection>\n')
+        for part, path in enumerate(paths):
+            f.write('    <DataSet part="{}" file="{}"/>\n'
+                    .format(part, os.path.basename(path)))
+        f.write('  </Collection>\n')
+        f.write('</VTKFile>\n')
+    return pvd
+
 def testLineReader():
     lines = ["G1 X4.4 Y-4.4 Z0.3 E0.33107 asdasdasd",\
         "G00",\
         "G0 F7200 X68.135 Y-.319",
         "TIME",
         "G0 F7200 X Y-.319",
-        "X4.4 Y-4.4 Z0.3 E0.33107 asdasdasd"]
+        "X4.4 Y-4.4 Z0.3 E0.33107 asdasdasd",
+        "G2 X10 Y0 I5 J0 E1.5",
+        "G03 X0 Y10 R-10 E2.1"]
     print("Trying out line reader...")
     for line in lines:
         print(line)
@@ -238,7 +987,27 @@ def testFileReader():
     vtk = "out.vtk"
     write2VtkFile( vtk, p, c )
     print("Wrote to " + vtk + "." )
-if __name__=="__main__":
+
+def addShardArguments( parser ):
+    '''
+    Add the options of sharded output to the argparse
+    parser of a converter.
+    '''
+    parser.add_argument('--shards', type=int, default=1,
+            help='Number of output files, written in parallel,\
+                    listed in a manifest.')
+    parser.add_argument('--shard-by', choices=('points', 'layer'),
+            default='points', dest='shardBy',
+            help='Split shards at equal point counts (points)\
+                    or also keep layers whole (layer).')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+            help='Number of writing processes. 0 for one per core.')
+
+def main(argv=None):
+    '''
+    Command line entry point. argv defaults to sys.argv[1:].
+    Logging is configured by the caller.
+    '''
     #get commandline arguments
     parser = argparse.ArgumentParser(description=
             "Read standard .gcode and output .vtk.")
@@ -251,8 +1020,46 @@ if __name__=="__main__":
     parser.add_argument('scaling', nargs='?', type=float, default=1e-3,
             help='By default values are scaled by 1e-3\
                     to change units from [mm] to [m]')
+    parser.add_argument('--arc-tolerance', type=float, default=0.01,
+            dest='arcTolerance',
+            help='Maximal distance between G2/G3 arcs and\
+                    the segments replacing them, in gcode units.')
+    parser.add_argument('--relative-extrusion', action='store_true',
+            dest='relativeExtrusion',
+            help='Start in relative extrusion mode (M83).\
+                    For files where any positive E means extrusion.')
+    addRegionArguments(parser)
+    addShardArguments(parser)
+    parser.add_argument('--travel-stats', action='store_true',
+            dest='travelStats',
+            help='Print travel distances and retractions per layer.')
+    parser.add_argument('--travel-vtk', dest='travelVtk',
+            help='Path to a .vtk file of the moves without extrusion.')
+    parser.add_argument('--bead-width', action='store_true',
+            dest='beadWidth',
+            help='Add the bead width of each line, computed from\
+                    its extrusion, as cell data.')
+    parser.add_argument('--bead', choices=('quad', 'hex'),
+            help='Write the beads as quads or hexahedra\
+                    instead of lines.')
+    parser.add_argument('--filament', type=float, default=1.75,
+            help='Filament diameter in [mm], for bead widths.')
+    parser.add_argument('--layer-height', type=float, dest='layerHeight',
+            help='Layer height in [mm], for bead widths. By default\
+                    the spacing of the Z of the toolpath, {} [mm] for\
+                    a single layer.'.format(gcodeBBox.layerHeight))
+    parser.add_argument('--compact', action='store_true',
+            help='Store points as float32 and lines as int32\
+                    while converting, for very large files.')
+    parser.add_argument('--lenient', action='store_true',
+            help='Skip malformed lines instead of stopping,\
+                    and report them.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not args.arcTolerance > 0:
+        parser.error("--arc-tolerance must be positive")
+    if args.shards > 1 and (args.beadWidth or args.bead):
+        parser.error("bead widths are not written to shards")
 
     #unpack
     path2gcode = args.path2gcode[ 0 ]
@@ -269,17 +1076,53 @@ if __name__=="__main__":
         path2vtk = args.path2vtk
         path2vtk = os.path.normcase( path2vtk )
 
-    #log file settings
-    logging.basicConfig(filename="logfile", level=logging.INFO,
-            format="%(levelname)s:%(message)s")
-    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
-
     logging.info("Target gcode file: {}".format(path2gcode))
     logging.info("Target vtk file: {}".format(path2vtk))
     logging.info("Scaling: {}".format(str(scaling)))
 
     #run file reader and get points and connectivities
-    p, c = readGcodeFile( path2gcode )
+    travel = None
+    if args.travelStats or args.travelVtk:
+        travel = travelLog()
+    extrusion = None
+    if args.beadWidth or args.bead:
+        extrusion = array('d')
+    errors = errorReport() if args.lenient else None
+    p, c = readGcodeFile( path2gcode, args.arcTolerance,
+            args.relativeExtrusion, regionFromArguments(args), travel,
+            extrusion, args.compact, errors )
+    if errors:
+        logging.warning("Skipped {} malformed lines".format(len(errors)))
+        errors.print(path2gcode)
+
+    if args.travelStats:
+        travel.print()
+    if args.travelVtk:
+        write2VtkFile( args.travelVtk, *travel.toMesh(), scaling )
 
     #run vtk writer and write to path2vtk
-    write2VtkFile( path2vtk, p, c, scaling )
+    if args.shards > 1:
+        pvd = write2VtkShards( path2vtk, p, c, args.shards, scaling,
+                args.shardBy == "layer", args.jobs or None )
+        logging.info("Wrote shards listed in: {}".format(pvd))
+    elif extrusion is not None:
+        if args.layerHeight is None:
+            args.layerHeight = layerHeightOf( p, c )
+        widths = beadWidths( p, c, extrusion, args.filament,
+                args.layerHeight )
+        if args.bead:
+            write2VtkBeads( path2vtk, p, c, widths, args.layerHeight,
+                    args.bead, scaling )
+        else:
+            write2VtkFile( path2vtk, p, c, scaling,
+                    { "width" : (scaling * widths).tolist() } )
+    else:
+        write2VtkFile( path2vtk, p, c, scaling )
+
+if __name__=="__main__":
+    #log file settings
+    logging.basicConfig(filename="logfile", level=logging.INFO,
+            format="%(levelname)s:%(message)s")
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+    main()
@@ -0,0 +1,11 @@
+;G2/G3 arcs should be tessellated, not read as chords
+G0 X0.0 Y0.0 Z0.2
+;half circle clockwise, center given by I J
+G2 X10.0 Y0.0 I5.0 J0.0 E1.0
+;quarter circle counterclockwise, center given by R
+G3 X15.0 Y5.0 R5.0 E2.0
+;full circle
+G2 I-2.0 J0.0 E3.0
+;helix, three quarters of a circle given by a negative R
+G0 X0.0 Y20.0
+G3 X5.0 Y25.0 Z0.4 R-5.0 E4.0
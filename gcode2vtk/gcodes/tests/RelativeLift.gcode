@@ -0,0 +1,10 @@
+;This test should store 3 segments: 1,0 1,1 0,1 0,0 at Z=0.6.
+;The G91/G90 Z lift keeps the relative extrusion of M83.
+M83
+G0 X1.0 Y0.0 Z0.2
+G91
+G1 Z0.4
+G90
+G1 X1.0 Y1.0 E0.5
+G1 X0.0 Y1.0 E0.5
+G1 X0.0 Y0.0 E0.5
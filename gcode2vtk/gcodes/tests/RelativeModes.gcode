@@ -0,0 +1,22 @@
+;This test should store the 4 sides of the square
+;0,0 1,0 1,1 0,1 at Z=0.2, read in 4 different ways.
+G90
+M82
+G0 X0.0 Y0.0 Z0.2
+G1 X1.0 Y0.0 E0.1
+;retraction then prime, no extrusion
+G1 E-1.0
+G1 E0.1
+;absolute extrusion after an E reset
+G92 E0
+G1 X1.0 Y1.0 E0.1
+;relative extrusion
+M83
+G1 X0.0 Y1.0 E0.1
+;relative positioning, shifted origin
+G91
+G1 X0.0 Y-1.0 E0.1
+G90
+G92 X10.0 Y10.0
+;travel, G90 keeps the M83 relative E, which decreases
+G1 X11.0 Y11.0 E-0.5
@@ -0,0 +1,6 @@
+;This test is a single layer: 2 segments 0,0 2,0 2,1 at Z=0.2.
+;The bounding box has zMin = zMax = 0.2, its mesh one element high.
+M82
+G0 X0.0 Y0.0 Z0.2
+G1 X2.0 Y0.0 E1.0
+G1 X2.0 Y1.0 E1.5
@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+
+'''
+Long-lived conversion server and its thin client.
+
+Converting thousands of small files one process at a time is dominated
+by interpreter startup, imports and logging set up. The server imports
+the converters once and runs their main() for each request it receives
+over a Unix socket (or a local TCP port where Unix sockets are missing).
+
+Start the server:
+    python gcodeServer.py --serve
+Run a conversion through it, with the same arguments as the tool:
+    python gcodeServer.py gcode2vtk part.gcode part.vtk
+Stop it:
+    python gcodeServer.py --stop
+
+The client side only needs the standard library modules imported below.
+The converters are imported by the server, on first use.
+'''
+
+import os
+import sys
+import json
+import socket
+
+#tool name -> script path, relative to this file
+TOOLS = {
+        "gcode2vtk" : os.path.join("gcode2vtk", "gcode2vtk.py"),
+        "gcode2CLI" : os.path.join("gcode2CLI", "gcode2CLI.py"),
+        "cli2gcode" : os.path.join("CLI2gcode", "cli2gcode.py"),
+        "bboxer"    : "bboxer.py",
+        }
+
+def defaultAddress():
+    '''
+    Per user socket path, or a local TCP address if the
+    platform has no Unix sockets.
+    '''
+    if hasattr(socket, "AF_UNIX"):
+        runtimeDir = os.environ.get("XDG_RUNTIME_DIR", "/tmp")
+        return os.path.join(runtimeDir,
+                "gcode-reader-{}.sock".format(os.getuid()))
+    else:
+        return "127.0.0.1:48621"
+
+def parseAddress( address:str ):
+    '''
+    "host:port" is a TCP address, anything else a socket path.
+    Return (family, address) ready to be handed to socket.
+    '''
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    else:
+        return socket.AF_UNIX, address
+
+def loadTool( name:str ):
+    '''
+    Import the script of a tool as a module.
+    The script directory is put on sys.path so that
+    its own imports resolve as when it is run directly.
+    A tool already imported, e.g. bboxer by the converters,
+    is not executed again.
+    '''
+    import importlib.util
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            TOOLS[name])
+    scriptDir = os.path.dirname(path)
+    if scriptDir not in sys.path:
+        sys.path.insert(0, scriptDir)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    #tools importing each other get this same module
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def runRequest( request:dict, modules:dict ):
+    '''
+    Run one conversion request in this process.
+    Return (exit status, captured standard output and log messages).
+    '''
+    import io
+    import logging
+    import contextlib
+    import traceback
+
+    tool = request.get("tool")
+    if tool not in TOOLS:
+        return 2, "Unknown tool: {}\n".format(tool)
+    if tool not in modules:
+        modules[tool] = loadTool(tool)
+
+    status = 0
+    out = io.StringIO()
+    prevDir = os.getcwd()
+    #messages the tool logs go to the client as well
+    handler = logging.StreamHandler(out)
+    logging.getLogger().addHandler(handler)
+    try:
+        #relative paths are relative to the client
+        os.chdir(request.get("cwd", prevDir))
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            status = modules[tool].main(request.get("argv", [])) or 0
+    except SystemExit as e:
+        #argparse errors and --help
+        if isinstance(e.code, int):
+            status = e.code
+        elif e.code is not None:
+            out.write(str(e.code) + "\n")
+            status = 1
+    except Exception:
+        out.write(traceback.format_exc())
+        status = 1
+    finally:
+        logging.getLogger().removeHandler(handler)
+        os.chdir(prevDir)
+    return status, out.getvalue()
+
+def serve( address:str ):
+    '''
+    Serve conversion requests until a stop request arrives.
+    Requests are handled one at a time: the converters are
+    CPU bound and change the working directory.
+    '''
+    import logging
+    import socketserver
+
+    family, addr = parseAddress(address)
+    modules = {}
+    #warm up: import every converter before the first request
+    for tool in TOOLS:
+        modules[tool] = loadTool(tool)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            if request.get("stop"):
+                reply = {"status" : 0, "output" : ""}
+                self.server.stopRequested = True
+            else:
+                logging.info("Request: {} {}".format(request.get("tool"),
+                    " ".join(request.get("argv", []))))
+                status, output = runRequest(request, modules)
+                reply = {"status" : status, "output" : output}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+
+    if family == socket.AF_UNIX:
+        #remove socket left behind by a previous server
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = socketserver.UnixStreamServer(addr, Handler)
+    else:
+        socketserver.TCPServer.allow_reuse_address = True
+        server = socketserver.TCPServer(addr, Handler)
+    server.stopRequested = False
+
+    logging.info("Serving on {}".format(address))
+    try:
+        while not server.stopRequested:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+
+def sendRequest( address:str, request:dict ):
+    '''
+    Send a request to the server and return its reply.
+    '''
+    family, addr = parseAddress(address)
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        s.connect(addr)
+        s.sendall((json.dumps(request) + "\n").encode())
+        with s.makefile("rb") as f:
+            return json.loads(f.readline())
+
+def main(argv=None):
+    '''
+    Command line entry point. argv defaults to sys.argv[1:].
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+
+    #parsed by hand: argparse would cost more than the client itself
+    address = defaultAddress()
+    if len(argv) >= 2 and argv[0] == "--address":
+        address = argv[1]
+        argv = argv[2:]
+
+    if not argv or argv[0] in ("-h", "--help"):
+        print(__doc__)
+        print("Tools:", ", ".join(TOOLS))
+        print("Use --address PATH|HOST:PORT before any other argument"
+                " to override the default address\n", address)
+        return 0
+
+    if argv[0] == "--serve":
+        import logging
+        logging.basicConfig(filename="logfile", level=logging.INFO,
+                format="%(levelname)s:%(message)s")
+        logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+        serve(address)
+        return 0
+
+    if argv[0] == "--stop":
+        request = {"stop" : True}
+    else:
+        request = {"tool" : argv[0], "argv" : argv[1:], "cwd" : os.getcwd()}
+
+    try:
+        reply = sendRequest(address, request)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print("No server listening on {}. Start one with --serve."
+                .format(address), file=sys.stderr)
+        return 1
+    sys.stdout.write(reply["output"])
+    return reply["status"]
+
+if __name__=="__main__":
+    sys.exit(main())
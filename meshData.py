@@ -0,0 +1,197 @@
+'''
+Compact containers for the points and connectivities of the readers.
+
+They behave like the lists of tuples used everywhere else (append,
+len, indexing, slicing, iteration) so that readers and writers work
+unchanged, but store float32 coordinates relative to an origin and
+int32 indices in flat arrays: about 12 bytes per point and 8 bytes
+per line instead of more than 100 for tuples of Python floats.
+
+NumPy sees them as arrays (np.asarray) and writers may use toArray
+to format them without going through tuples.
+'''
+
+import bisect
+from array import array
+
+#significant digits kept from float32 offsets
+OFFSETDIGITS = 7
+#exact powers of ten, shared by the scalar and NumPy roundings
+#so that both give the same floats
+POWERS = [ float("1e{}".format(k)) for k in range(-40, 41) ]
+
+def roundingScale( offset:float ):
+    '''
+    Power of ten by which origin + offset is multiplied before
+    rounding to an integer, keeping OFFSETDIGITS of the offset.
+    '''
+    #offset is at least 1e(k - 40)
+    k = bisect.bisect_right(POWERS, abs(offset)) - 1
+    return POWERS[min(max(OFFSETDIGITS - 1 - (k - 40) + 40, 0), 80)]
+
+def absoluteCoordinate( origin:float, offset:float ):
+    '''
+    origin + offset, rounded to the significant digits of the
+    float32 offset: coordinates read from decimal text come back
+    as written (0.47, not 0.47000000298023224) in the writers.
+    '''
+    if offset == 0.0:
+        return origin
+    scale = roundingScale(offset)
+    return round((origin + offset) * scale) / scale
+
+class compactPointList:
+    '''
+    List of 3D points stored as float32 offsets from origin.
+    Unless given, origin is the first point appended, which keeps
+    float32 offsets precise for parts far from the machine origin.
+    Indexing returns tuples of floats, in absolute coordinates
+    (see absoluteCoordinate) multiplied by factor (see scale).
+    Writers should convert the list with np.asarray, which gives
+    the same values, rather than index it point by point.
+    '''
+    def __init__(self, origin=None, factor=1.0):
+        self.origin = None if origin is None else tuple(origin)
+        self.factor = factor
+        self.coords = array('f')
+
+    def append(self, p):
+        if self.origin is None:
+            self.origin = (float(p[0]), float(p[1]), float(p[2]))
+        o = self.origin
+        self.coords.extend((p[0] - o[0], p[1] - o[1], p[2] - o[2]))
+
+    def extend(self, points):
+        for p in points:
+            self.append(p)
+
+    def scale(self, factor):
+        '''
+        Scaling by factor around the machine origin, applied
+        to the rounded coordinates as the readers scale lists.
+        '''
+        self.factor *= factor
+
+    def __len__(self):
+        return len(self.coords) // 3
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("compactPointList slices need step 1")
+            sliced = compactPointList(self.origin, self.factor)
+            sliced.coords = self.coords[3*start : 3*stop]
+            return sliced
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("point index out of range")
+        c = self.coords
+        o = self.origin
+        point = (absoluteCoordinate(o[0], c[3*i]),
+                absoluteCoordinate(o[1], c[3*i+1]),
+                absoluteCoordinate(o[2], c[3*i+2]))
+        if self.factor != 1:
+            return tuple(self.factor * x for x in point)
+        return point
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def toArray(self):
+        '''
+        float32 offsets as a NumPy array of shape (n, 3),
+        sharing memory with the list, and the origin.
+        '''
+        import numpy as np
+
+        return np.frombuffer(self.coords, dtype=np.float32).reshape(-1, 3), \
+                self.origin or (0.0, 0.0, 0.0)
+
+    def __array__(self, dtype=None, copy=None):
+        import numpy as np
+
+        offsets, origin = self.toArray()
+        offsets = offsets.astype(float)
+        points = offsets + np.asarray(origin)
+        #as absoluteCoordinate, with the same powers of ten
+        powers = np.asarray(POWERS)
+        k = np.searchsorted(powers, np.abs(offsets), side="right") - 1
+        scale = powers[np.clip(OFFSETDIGITS - 1 - (k - 40) + 40, 0, 80)]
+        points = np.where(offsets != 0,
+                np.round(points * scale) / scale, points)
+        if self.factor != 1:
+            points = self.factor * points
+        return points if dtype is None else points.astype(dtype)
+
+class compactConnectivity:
+    '''
+    List of lines, pairs of point indices, stored as int32.
+    Indexing returns tuples of ints.
+    '''
+    def __init__(self):
+        self.indices = array('i')
+
+    def append(self, line):
+        self.indices.extend((line[0], line[1]))
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def __len__(self):
+        return len(self.indices) // 2
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("compactConnectivity slices need step 1")
+            sliced = compactConnectivity()
+            sliced.indices = self.indices[2*start : 2*stop]
+            return sliced
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("line index out of range")
+        return (self.indices[2*i], self.indices[2*i+1])
+
+    def __iter__(self):
+        l = self.indices
+        for i in range(0, len(l), 2):
+            yield (l[i], l[i+1])
+
+    def toArray(self):
+        '''
+        Indices as a NumPy int32 array of shape (n, 2),
+        sharing memory with the list.
+        '''
+        import numpy as np
+
+        return np.frombuffer(self.indices, dtype=np.int32).reshape(-1, 2)
+
+    def __array__(self, dtype=None, copy=None):
+        lines = self.toArray()
+        return lines if dtype is None else lines.astype(dtype)
+
+def segmentPoints( pointList, connectivity, chunk=100000 ):
+    '''
+    Iterate over the (start point, end point) of the lines of
+    connectivity. Compact containers are converted with NumPy,
+    chunk lines at a time, instead of point by point.
+    '''
+    if not isinstance(pointList, compactPointList):
+        for line in connectivity:
+            yield pointList[line[0]], pointList[line[1]]
+        return
+
+    import numpy as np
+
+    points = np.asarray(pointList)
+    lines = np.asarray(connectivity).reshape(-1, 2)
+    for start in range(0, len(lines), chunk):
+        chunkLines = lines[start : start + chunk]
+        yield from zip(points[chunkLines[:, 0]].tolist(),
+                points[chunkLines[:, 1]].tolist())
@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+
+'''
+Rasterizes the deposited toolpath of a .gcode into an occupancy grid.
+
+A voxel is filled if its center lies in the bead of a segment:
+within half a nozzle diameter of the segment in XY and at most one
+layer height below it in Z. Each filled voxel stores its activation
+time, the time at which the nozzle first deposits material in it,
+assuming a constant deposition speed and no travel time.
+
+The grid is written either as a legacy VTK image (STRUCTURED_POINTS,
+empty voxels have a time of -1) or, for .npz outputs, as a compact
+sparse NumPy archive of the filled voxel indices and their times.
+
+Requires NumPy.
+'''
+
+import os
+import sys
+import argparse
+import logging
+
+#the gcode reader lives in gcode2vtk
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "gcode2vtk"))
+from gcode2vtk import readGcodeFile, layerHeightOf
+from bboxer import gcodeBBox
+
+class occupancyGrid:
+    '''
+    Regular grid of voxels, sparse: only filled voxels are stored.
+        origin:     corner of the grid
+        spacing:    voxel dimensions
+        shape:      number of voxels along x, y and z
+        indices:    flat (C order) indices of the filled voxels
+        times:      activation times of the filled voxels
+    '''
+    def __init__(self, origin, spacing, shape, indices, times):
+        self.origin  = tuple(origin)
+        self.spacing = tuple(spacing)
+        self.shape   = tuple(shape)
+        self.indices = indices
+        self.times   = times
+
+    def dense(self, empty=-1.0):
+        '''
+        Activation times as a dense array of the grid shape,
+        empty voxels set to empty.
+        '''
+        import numpy as np
+
+        grid = np.full(self.shape, empty, dtype=np.float32)
+        grid.reshape(-1)[self.indices] = self.times
+        return grid
+
+    def writeNpz(self, FileName):
+        '''
+        Write the sparse grid to a compressed .npz archive.
+        '''
+        import numpy as np
+
+        np.savez_compressed(FileName, origin=self.origin,
+                spacing=self.spacing, shape=self.shape,
+                indices=self.indices, times=self.times)
+        logging.info("Wrote {} filled voxels to file\n {}"
+                .format(len(self.indices), FileName))
+
+    def writeVtk(self, FileName, scaling=1e-3):
+        '''
+        Write the grid to a legacy binary VTK image,
+        activation times as cell data.
+        '''
+        import numpy as np
+
+        nx, ny, nz = self.shape
+        #VTK images are x fastest
+        times = self.dense().transpose(2, 1, 0)
+        with open(FileName, "wb") as f:
+            f.write(b"# vtk DataFile Version 2.0\n")
+            f.write(b"Occupancy grid\n")
+            f.write(b"BINARY\n")
+            f.write(b"DATASET STRUCTURED_POINTS\n")
+            f.write("DIMENSIONS {} {} {}\n"
+                    .format(nx + 1, ny + 1, nz + 1).encode())
+            f.write("ORIGIN {} {} {}\n"
+                    .format(*[scaling * x for x in self.origin]).encode())
+            f.write("SPACING {} {} {}\n"
+                    .format(*[scaling * x for x in self.spacing]).encode())
+            f.write("CELL_DATA {}\n".format(nx * ny * nz).encode())
+            f.write(b"SCALARS activationTime float 1\n")
+            f.write(b"LOOKUP_TABLE default\n")
+            f.write(times.astype(">f4").tobytes())
+            f.write(b"\n")
+        logging.info("Wrote {}x{}x{} voxels to file\n {}"
+                .format(nx, ny, nz, FileName))
+
+def voxelizeLayer( task:tuple ):
+    '''
+    Rasterize the segments of one or more layers.
+    task is (segments, startTimes, origin, spacing, shape,
+    nozzleDiam, layerHeight, speed) where segments is an
+    array of shape (n, 2, 3) and startTimes the times at
+    which the segments start.
+    Return the flat indices of the filled voxels and their
+    activation times, each voxel appearing once.
+    '''
+    import numpy as np
+
+    segments, startTimes, origin, spacing, shape, \
+            nozzleDiam, layerHeight, speed = task
+    origin  = np.asarray(origin)
+    spacing = np.asarray(spacing)
+    radius  = nozzleDiam / 2
+
+    #samples along the segments, closer than half a voxel
+    p1 = segments[:, 0, :]
+    p2 = segments[:, 1, :]
+    lengths = np.linalg.norm(p2 - p1, axis=1)
+    step = min(spacing[0], spacing[1]) / 2
+    numSamples = np.ceil(lengths / step).astype(np.int64) + 1
+    segmentIndex = np.repeat(np.arange(len(segments)), numSamples)
+    firstSample = np.cumsum(numSamples) - numSamples
+    t = (np.arange(segmentIndex.size) - firstSample[segmentIndex]) \
+            / np.maximum(numSamples[segmentIndex] - 1, 1)
+    samples = p1[segmentIndex] + t[:, None] * \
+            (p2[segmentIndex] - p1[segmentIndex])
+    sampleTimes = startTimes[segmentIndex] + \
+            t * lengths[segmentIndex] / speed
+
+    #voxels around the samples: XY disk times Z range below the sample
+    reach = np.ceil(radius / spacing[0:2]).astype(np.int64) + 1
+    depth = int(np.ceil(layerHeight / spacing[2])) + 1
+    di, dj, dk = np.meshgrid(np.arange(-reach[0], reach[0] + 1),
+            np.arange(-reach[1], reach[1] + 1),
+            np.arange(-depth, 1), indexing="ij")
+    stencil = np.stack([di.ravel(), dj.ravel(), dk.ravel()], axis=1)
+
+    shape = np.asarray(shape)
+    indices = []
+    times = []
+    #chunks of samples to bound the memory of samples x stencil
+    chunk = max(1, 2**22 // len(stencil))
+    for start in range(0, len(samples), chunk):
+        s = samples[start : start + chunk]
+        cell = np.floor((s - origin) / spacing).astype(np.int64)
+        cells = cell[:, None, :] + stencil[None, :, :]
+        centers = origin + (cells + 0.5) * spacing
+        d = centers - s[:, None, :]
+        inside = (d[..., 0]**2 + d[..., 1]**2 <= radius**2) \
+                & (d[..., 2] <= 0) & (d[..., 2] > -layerHeight) \
+                & np.all((cells >= 0) & (cells < shape), axis=2)
+        sampleIndex, _ = np.nonzero(inside)
+        indices.append(np.ravel_multi_index(cells[inside].T, shape))
+        times.append(sampleTimes[start + sampleIndex])
+
+    return firstActivation(np.concatenate(indices), np.concatenate(times))
+
+def firstActivation( indices, times ):
+    '''
+    Keep for each voxel index its earliest time.
+    '''
+    import numpy as np
+
+    order = np.lexsort((times, indices))
+    indices = indices[order]
+    times = times[order]
+    first = np.ones(len(indices), dtype=bool)
+    first[1:] = indices[1:] != indices[:-1]
+    return indices[first], times[first]
+
+def voxelize( pointList:list, connectivity:list, voxelSize, nozzleDiam,
+        layerHeight, speed=1.0, numWorkers=None ):
+    '''
+    Rasterize the segments of a toolpath into an occupancyGrid.
+
+    voxelSize is the (dx, dy, dz) size of the voxels and speed
+    the deposition speed, the activation times being the deposited
+    length divided by speed. Layers, i.e. segments ending at the
+    same Z to a micron, are rasterized in parallel by numWorkers
+    processes, consecutive layers being merged into tasks of a
+    few thousand segments or more, e.g. for spiral toolpaths whose
+    every segment is a layer.
+    '''
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+
+    points = np.asarray(pointList, dtype=float)
+    lines = np.asarray(connectivity, dtype=np.int64).reshape(-1, 2)
+    segments = points[lines]
+    lengths = np.linalg.norm(segments[:, 1] - segments[:, 0], axis=1)
+    startTimes = (np.cumsum(lengths) - lengths) / speed
+
+    #grid around the beads
+    spacing = np.asarray(voxelSize, dtype=float)
+    radius = nozzleDiam / 2
+    origin = points.min(axis=0) - (radius, radius, layerHeight)
+    extent = points.max(axis=0) + (radius, radius, 0.0) - origin
+    shape = np.maximum(np.ceil(extent / spacing - 1e-9), 1).astype(np.int64)
+
+    #sort segments by layer once, then cut the sorted segments
+    #at the layer starts crossing a multiple of taskSize
+    numWorkers = numWorkers or os.cpu_count()
+    taskSize = max(len(segments) // (4*numWorkers), 4096)
+    z = np.round(segments[:, 1, 2], 3)
+    order = np.argsort(z, kind="stable")
+    layerStarts = np.flatnonzero(np.diff(z[order])) + 1
+    cuts = layerStarts[np.diff(layerStarts // taskSize, prepend=0) > 0]
+    tasks = [ (segments[task], startTimes[task], tuple(origin),
+        tuple(spacing), tuple(shape), nozzleDiam, layerHeight, speed)
+        for task in np.split(order, cuts) if len(task) ]
+
+    with ProcessPoolExecutor( numWorkers ) as pool:
+        results = list(pool.map(voxelizeLayer, tasks,
+            chunksize=max(1, len(tasks) // (4*numWorkers))))
+
+    if results:
+        indices, times = firstActivation(
+                np.concatenate([r[0] for r in results]),
+                np.concatenate([r[1] for r in results]))
+    else:
+        indices = np.zeros(0, dtype=np.int64)
+        times = np.zeros(0)
+    return occupancyGrid(origin, spacing, shape,
+            indices, times.astype(np.float32))
+
+def main(argv=None):
+    '''
+    Command line entry point. argv defaults to sys.argv[1:].
+    Logging is configured by the caller.
+    '''
+    parser = argparse.ArgumentParser(description=
+            "Rasterize the deposited toolpath of a .gcode\
+                    into an occupancy grid.")
+    parser.add_argument('gcodeFile', nargs=1, help="Path of .gcode file")
+    parser.add_argument('gridFile', nargs='?',
+            help="Path of output, .vtk or .npz.\
+                    If not provided, derived from gcodeFile.")
+    parser.add_argument('--voxel-size', nargs='+', type=float,
+            dest='voxelSize',
+            help="Voxel size in [mm], one value for dx=dy\
+                    or three values dx dy dz.\
+                    By default half the nozzle diameter\
+                    and the layer height.")
+    parser.add_argument('--nozzle', type=float,
+            help="Nozzle diameter in [mm], bead width.\
+                    By default {}.".format(gcodeBBox.nozzleDiam))
+    parser.add_argument('--layer-height', type=float, dest='layerHeight',
+            help="Layer height in [mm]. By default the spacing\
+                    of the Z of the toolpath.")
+    parser.add_argument('--speed', type=float, default=1.0,
+            help="Deposition speed in [mm/s]. With the default\
+                    of 1, activation times are deposited lengths.")
+    parser.add_argument('--scaling', type=float, default=1e-3,
+            help="Scaling of the .vtk coordinates,\
+                    [mm] to [m] by default.")
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+            help="Number of processes. 0 for one per core.")
+
+    args = parser.parse_args(argv)
+    if args.voxelSize and len(args.voxelSize) not in (1, 3):
+        parser.error("--voxel-size takes 1 or 3 values")
+    if args.voxelSize and min(args.voxelSize) <= 0:
+        parser.error("--voxel-size must be positive")
+    for option, value in (("--nozzle", args.nozzle),
+            ("--layer-height", args.layerHeight), ("--speed", args.speed)):
+        if value is not None and value <= 0:
+            parser.error("{} must be positive".format(option))
+
+    gcodeFile = args.gcodeFile[0]
+    if args.gridFile:
+        gridFile = args.gridFile
+    else:
+        gridFile = os.path.splitext(os.path.basename(gcodeFile))[0] \
+                + "-voxels.vtk"
+
+    p, c = readGcodeFile(gcodeFile)
+    if not c:
+        logging.warning("No extrusion found in {}".format(gcodeFile))
+        return
+
+    nozzleDiam  = args.nozzle or gcodeBBox.nozzleDiam
+    layerHeight = args.layerHeight or layerHeightOf(p, c)
+    if not args.voxelSize:
+        voxelSize = (nozzleDiam/2, nozzleDiam/2, layerHeight)
+    elif len(args.voxelSize) == 1:
+        voxelSize = (args.voxelSize[0], args.voxelSize[0], layerHeight)
+    else:
+        voxelSize = tuple(args.voxelSize)
+
+    logging.info("Voxel size: {}".format(voxelSize))
+    logging.info("Nozzle diameter: {}, layer height: {}"
+            .format(nozzleDiam, layerHeight))
+
+    grid = voxelize(p, c, voxelSize, nozzleDiam, layerHeight,
+            args.speed, args.jobs or None)
+
+    if gridFile.endswith(".npz"):
+        grid.writeNpz(gridFile)
+    else:
+        grid.writeVtk(gridFile, args.scaling)
+
+if __name__=="__main__":
+    #log file settings
+    logging.basicConfig(filename="logfile", level=logging.INFO,
+            format="%(levelname)s:%(message)s")
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+    main()